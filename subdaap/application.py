@@ -1,7 +1,10 @@
 from subdaap.provider import Provider
 from subdaap.database import Database
 from subdaap.connection import Connection
+from subdaap.prefetch import Prefetcher
 from subdaap.state import State
+from subdaap.downloads import DownloadScheduler
+from subdaap.handles import HandlePool
 from subdaap import cache, config, webserver
 
 from daapserver import DaapServer
@@ -38,6 +41,7 @@ class Application(object):
         self.setup_open_files()
         self.setup_database()
         self.setup_state()
+        self.setup_downloads()
         self.setup_connections()
         self.setup_cache()
         self.setup_provider()
@@ -95,26 +99,70 @@ class Application(object):
         Setup the caches for items and artwork.
         """
 
+        # Open file handles are shared between both caches.
+        handles = HandlePool(self.config["Advanced"]["cache open files"])
+
         # Initialize caches for items and artwork.
         item_cache = cache.ItemCache(
             path=self.get_cache_dir(
                 self.config["Provider"]["item cache dir"]),
             max_size=self.config["Provider"]["item cache size"],
             prune_threshold=self.config[
-                "Provider"]["item cache prune threshold"])
+                "Provider"]["item cache prune threshold"],
+            eviction=self.config["Provider"]["item cache eviction"],
+            handles=handles,
+            max_chunk_size=self.config["Provider"]["item max chunk size"],
+            memory_size=self.config["Provider"]["item cache memory size"])
         artwork_cache = cache.ArtworkCache(
             path=self.get_cache_dir(self.config[
                 "Provider"]["artwork cache dir"]),
             max_size=self.config["Provider"]["artwork cache size"],
             prune_threshold=self.config[
-                "Provider"]["artwork cache prune threshold"])
+                "Provider"]["artwork cache prune threshold"],
+            eviction=self.config["Provider"]["artwork cache eviction"],
+            memory_size=self.config["Provider"]["artwork cache memory size"],
+            sizes=self.config["Provider"]["artwork sizes"],
+            handles=handles)
+
+        # Initialize the cache for the heads of items, if enabled.
+        if self.config["Provider"]["item head seconds"]:
+            head_cache = cache.HeadCache(
+                path=self.get_cache_dir(
+                    self.config["Provider"]["item head cache dir"]),
+                max_size=self.config["Provider"]["item head cache size"],
+                prune_threshold=self.config[
+                    "Provider"]["item cache prune threshold"])
+        else:
+            head_cache = None
 
         # Create a cache manager
         self.cache_manager = cache.CacheManager(
             db=self.db,
             item_cache=item_cache,
             artwork_cache=artwork_cache,
-            connections=self.connections)
+            connections=self.connections,
+            concurrency=self.config["Provider"]["permanent cache concurrency"],
+            bandwidth=self.config["Provider"]["permanent cache bandwidth"],
+            head_cache=head_cache,
+            head_seconds=self.config["Provider"]["item head seconds"],
+            head_containers=self.config["Provider"]["item head containers"],
+            popular_size=self.config["Provider"]["item popular cache size"])
+
+        # Create a prefetcher for items that are likely to be played next.
+        self.prefetcher = Prefetcher(
+            db=self.db,
+            cache_manager=self.cache_manager,
+            connections=self.connections,
+            count=self.config["Provider"]["item prefetch"],
+            budget=self.config["Provider"]["item prefetch budget"])
+
+    def setup_downloads(self):
+        """
+        Setup the scheduler that coordinates downloads from all connections.
+        """
+
+        self.download_scheduler = DownloadScheduler(
+            bandwidth=self.config["Provider"]["download bandwidth"])
 
     def setup_connections(self):
         """
@@ -135,7 +183,9 @@ class Application(object):
                 synchronization=section["synchronization"],
                 synchronization_interval=section["synchronization interval"],
                 transcode=section["transcode"],
-                transcode_unsupported=section["transcode unsupported"])
+                transcode_unsupported=section["transcode unsupported"],
+                transcode_bitrate=section["transcode bitrate"],
+                download_scheduler=self.download_scheduler)
 
     def setup_provider(self):
         """
@@ -151,7 +201,8 @@ class Application(object):
             db=self.db,
             state=self.state,
             connections=self.connections,
-            cache_manager=self.cache_manager)
+            cache_manager=self.cache_manager,
+            prefetcher=self.prefetcher)
 
         # Do an initial synchronization if required.
         for connection in self.connections.itervalues():
@@ -205,6 +256,12 @@ class Application(object):
             self.cache_manager.clean,
             max_instances=1, trigger="interval", minutes=cache_interval)
 
+        # Scheduler task to pin the most played items.
+        if self.config["Provider"]["item popular cache size"]:
+            self.scheduler.add_job(
+                self.cache_manager.cache, max_instances=1, trigger="interval",
+                minutes=self.config["Provider"]["item popular cache interval"])
+
         # Schedule tasks to synchronize each connection.
         for connection in self.connections.itervalues():
             self.scheduler.add_job(
@@ -264,6 +321,9 @@ class Application(object):
         logger.debug("Stopping task scheduler.")
         self.scheduler.shutdown()
 
+        # Record the recent access order of the caches.
+        self.cache_manager.compact(force=True)
+
     def get_cache_dir(self, *path):
         """
         Resolve the path to a cache directory. The path is relative to the data
@@ -1,9 +1,16 @@
-from subdaap.utils import human_bytes, exhaust
-from subdaap import stream
+from subdaap.utils import human_bytes, exhaust, in_list
+from subdaap.warmer import CacheWarmer
+from subdaap.handles import HandlePool
+from subdaap import stream, policy, downloads
+
+from daapserver.utils import parse_byte_range
 
 from collections import OrderedDict
+from functools import partial
 
+import hashlib
 import logging
+import shutil
 import gevent
 import time
 import mmap
@@ -15,26 +22,156 @@ logger = logging.getLogger(__name__)
 # Time in seconds to wait for another item to finish, before failing.
 TIMEOUT_WAIT_FOR_READY = 60
 
+# Name of the manifest file, which is stored in the cache folder.
+MANIFEST_FILE = ".manifest"
+
+# Minimum number of lines appended to the manifest, before it is compacted.
+# The manifest is compacted once the appended lines outnumber the items.
+MANIFEST_COMPACT_LINES = 1000
+
+# Prefix of artwork cache keys that are shared by all items of an album.
+ARTWORK_ALBUM_PREFIX = "album-"
+
+# Number of times an item must be played, before it is kept in memory.
+MEMORY_PROMOTE_ACCESSES = 2
+
+# Number of plays after which all play frequencies are halved, so items that
+# were popular in the past do not stay in memory forever.
+MEMORY_AGING_ACCESSES = 1000
+
+# Minimum number of plays of an item, before it can be pinned because it is
+# popular.
+POPULAR_MIN_PLAYS = 2
+
+# Time in seconds after which the plays of an item count half, when ranking
+# popular items.
+POPULAR_HALF_LIFE = 30 * 24 * 3600
+
+
+def artwork_cache_key(item_id, album_id, album_art, size=None):
+    """
+    Get the artwork cache key of an item. Items of an album with artwork share
+    one cache entry, so the artwork is downloaded and stored only once. Each
+    size variant of the artwork is stored as a separate entry.
+
+    :param int item_id: ID of the item.
+    :param int album_id: ID of the album of the item, if any.
+    :param bool album_art: True if the album has artwork.
+    :param int size: Size of the variant, or None for the original artwork.
+    """
+
+    if album_id and album_art:
+        cache_key = "%s%d" % (ARTWORK_ALBUM_PREFIX, album_id)
+    else:
+        cache_key = item_id
+
+    if size:
+        return "%s-%d" % (cache_key, size)
+
+    return cache_key
+
 
 class FileCacheItem(object):
     __slots__ = (
         "lock", "ready", "uses", "size", "type", "iterator", "data",
-        "permanent"
+        "permanent", "accessed", "downloading", "prioritize", "claimed"
     )
 
     def __init__(self):
         self.lock = None
         self.ready = None
         self.uses = 0
+        self.downloading = False
+        self.prioritize = None
+        self.claimed = None
 
         self.size = 0
         self.iterator = None
         self.data = None
         self.permanent = False
+        self.accessed = 0
+
+
+class MemoryCache(object):
+    """
+    In-memory cache of file contents, bounded by a byte budget. The least
+    recently used entries are evicted first.
+    """
+
+    def __init__(self, max_size):
+        """
+        Construct a new memory cache.
+
+        :param int max_size: Maximum cache size (in MB), or 0 to disable.
+        """
+
+        self.max_size = max_size * 1024 * 1024
+        self.current_size = 0
+
+        self.items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cache_key):
+        """
+        Get data from the cache, or None if it is not in the cache. The item
+        is marked as most-recently accessed.
+
+        :param str cache_key:
+        """
+
+        if not self.max_size:
+            return
+
+        try:
+            data = self.items.pop(cache_key)
+        except KeyError:
+            self.misses += 1
+            return
+
+        self.items[cache_key] = data
+        self.hits += 1
+
+        return data
+
+    def put(self, cache_key, data):
+        """
+        Add data to the cache. The least recently used items are evicted until
+        the data fits. Data that is larger than the cache is ignored.
+
+        :param str cache_key:
+        :param str data:
+        """
+
+        if len(data) > self.max_size:
+            return
+
+        self.remove(cache_key)
+
+        while self.current_size + len(data) > self.max_size:
+            _, old_data = self.items.popitem(last=False)
+            self.current_size -= len(old_data)
+
+        self.items[cache_key] = data
+        self.current_size += len(data)
+
+    def remove(self, cache_key):
+        """
+        Remove data from the cache, if it is in the cache.
+
+        :param str cache_key:
+        """
+
+        data = self.items.pop(cache_key, None)
+
+        if data is not None:
+            self.current_size -= len(data)
 
 
 class FileCache(object):
-    def __init__(self, path, max_size, prune_threshold):
+    def __init__(self, path, max_size, prune_threshold, eviction="lru",
+                 handles=None, max_chunk_size=0, memory_size=0):
         """
         Construct a new file cache.
 
@@ -42,6 +179,15 @@ class FileCache(object):
         :param int max_size: Maximum cache size (in MB), or 0 to disable.
         :param float prune_threshold: Percentage of size to prune when cache
                                       size exceeds maximum size.
+        :param str eviction: Name of the eviction policy that determines which
+                             items are pruned first.
+        :param HandlePool handles: Pool that bounds the number of open file
+                                   handles, possibly shared with other caches.
+        :param int max_chunk_size: Maximum size (in KB) of the chunks that are
+                                   streamed to fast clients, or 0 to use a
+                                   fixed chunk size.
+        :param int memory_size: Maximum size (in MB) of items that are kept in
+                                memory, or 0 to disable.
         """
 
         # This attribute is used so often, it makes the code less long.
@@ -50,53 +196,62 @@ class FileCache(object):
         self.path = path
         self.max_size = max_size * 1024 * 1024
         self.prune_threshold = prune_threshold
+        self.max_chunk_size = max_chunk_size * 1024
         self.current_size = 0
 
         self.items = OrderedDict()
+        self.memory = MemoryCache(memory_size)
+        self.policy = policy.create_policy(eviction)
+        self.costs = policy.RefetchCosts()
+        self.idle = set()
+        self.handles = handles if handles is not None else HandlePool()
         self.items_lock = gevent.lock.Semaphore()
         self.prune_lock = gevent.lock.Semaphore()
 
         self.permanent_cache_keys = None
 
+        self.manifest_file = os.path.join(self.path, MANIFEST_FILE)
+        self.manifest_fd = None
+        self.manifest_lines = 0
+        self.manifest_pending = None
+
     def index(self, permanent_cache_keys):
         """
-        Read the cache folder and determine its size by summing the file
-        size of its contents.
+        Determine the contents of the cache and its size. The manifest is used
+        if it exists, and reconciled with the cache folder in the background.
+        Otherwise, the cache folder is walked and the manifest is created.
         """
 
         self.permanent_cache_keys = permanent_cache_keys
 
-        # Walk all files and sum their size
-        for root, directories, files in os.walk(self.path):
-            if directories:
-                logger.warning(
-                    "%s: Found unexpected directories in cache path: %s",
-                    self.name, root)
-
-            for cache_file in files:
-                try:
-                    cache_file = os.path.join(self.path, cache_file)
-                    cache_key = self.cache_file_to_cache_key(cache_file)
-                except ValueError:
-                    logger.warning(
-                        "%s: Found unexpected file in cache path: %s",
-                        self.name, cache_file)
-                    continue
-
+        if self.has_manifest():
+            self.load_manifest()
+            reconcile = True
+        else:
+            # Walk all files and sum their size
+            for cache_key, cache_file in self.walk():
                 # Add it to the cache, but do not overwrite an existing item.
                 if cache_key not in self.items:
                     self.items[cache_key] = FileCacheItem()
 
-                self.items[cache_key].size = os.stat(cache_file).st_size
-                self.items[cache_key].permanent = \
-                    cache_key in permanent_cache_keys
+                stat = os.stat(cache_file)
+
+                self.items[cache_key].size = stat.st_size
+                self.items[cache_key].accessed = stat.st_atime
+
+            reconcile = False
 
         # Sum sizes of all non-permanent files
         size = 0
         count = 0
 
-        for item in self.items.itervalues():
+        for cache_key, item in sorted(
+                self.items.iteritems(), key=lambda x: x[1].accessed):
+            item.permanent = cache_key in permanent_cache_keys
+
+            # Permanent items are never evicted.
             if not item.permanent:
+                self.track(cache_key, item)
                 size += item.size
                 count += 1
 
@@ -107,13 +262,385 @@ class FileCache(object):
             self.name, len(self.items), len(self.items) - count,
             human_bytes(self.current_size), human_bytes(self.max_size))
 
+        self.write_manifest()
+
+        if reconcile:
+            gevent.spawn(self.reconcile)
+
+    def pin(self, permanent_cache_keys):
+        """
+        Change the set of permanent items. Items that become permanent are not
+        pruned anymore and do not count towards the cache size, while items
+        that are not permanent anymore can be pruned again.
+        """
+
+        with self.items_lock:
+            self.permanent_cache_keys = permanent_cache_keys
+
+            for cache_key, cache_item in self.items.iteritems():
+                permanent = cache_key in permanent_cache_keys
+
+                if permanent == cache_item.permanent:
+                    continue
+
+                cache_item.permanent = permanent
+
+                if permanent:
+                    self.policy.remove(cache_key)
+                    self.current_size -= cache_item.size
+                else:
+                    self.track(cache_key, cache_item)
+                    self.current_size += cache_item.size
+
+    def track(self, cache_key, cache_item):
+        """
+        Add an item to the eviction policy, with its size and the estimated
+        cost to download it again.
+
+        :param str cache_key:
+        :param FileCacheItem cache_item:
+        """
+
+        self.policy.add(cache_key)
+        self.policy.weigh(
+            cache_key, cache_item.size,
+            self.costs.estimate(cache_key, cache_item.size))
+
+    def has_manifest(self):
+        """
+        Return True if the cache folder has a manifest.
+        """
+
+        return os.path.isfile(self.manifest_file)
+
+    def load_manifest(self):
+        """
+        Load the cache contents from the manifest. The manifest consists of
+        lines that add (`+ key size accessed [cost class]`) or remove
+        (`- key`) an item, or that record the download rate of a cost class
+        (`~ cost_class rate`). Lines that cannot be parsed, e.g. because of a
+        crash while writing, are ignored.
+        """
+
+        items = {}
+
+        with open(self.manifest_file, "r") as manifest_fd:
+            for line in manifest_fd:
+                fields = line.split()
+
+                try:
+                    if fields[0] == "~" and len(fields) == 3:
+                        self.costs.rates[fields[1]] = float(fields[2])
+                        continue
+
+                    cache_key = self.cache_file_to_cache_key(fields[1])
+
+                    if fields[0] == "+" and len(fields) in (4, 5):
+                        items[cache_key] = \
+                            int(fields[2]), float(fields[3]), fields[4:]
+                    elif fields[0] == "-" and len(fields) == 2:
+                        items.pop(cache_key, None)
+                    else:
+                        raise ValueError("Unknown operation.")
+                except (IndexError, ValueError):
+                    logger.warning(
+                        "%s: Skipping invalid manifest line: %r",
+                        self.name, line)
+
+        # Least recently accessed items go first.
+        for cache_key, (size, accessed, cost_class) in sorted(
+                items.iteritems(), key=lambda x: x[1][1]):
+            self.items[cache_key] = cache_item = FileCacheItem()
+
+            cache_item.size = size
+            cache_item.accessed = accessed
+
+            if cost_class:
+                self.costs.classes[cache_key] = cost_class[0]
+
+    def write_manifest(self):
+        """
+        Write the current cache contents to a new manifest, which replaces the
+        existing one atomically. Further changes are appended to it.
+
+        The manifest is written in the thread pool, from a snapshot of the
+        items. Changes that are made in the meantime are appended to the new
+        manifest before it replaces the existing one.
+        """
+
+        # Another greenlet is writing the manifest already.
+        if self.manifest_pending is not None:
+            return
+
+        temp_file = "%s.temp" % self.manifest_file
+
+        # A plain copy of the items is cheap, because no tuples are created.
+        with self.items_lock:
+            snapshot = dict(self.items)
+            classes = dict(self.costs.classes)
+            rates = dict(self.costs.rates)
+            self.manifest_pending = []
+
+        try:
+            gevent.get_hub().threadpool.apply(
+                self.write_manifest_file,
+                (temp_file, snapshot, classes, rates))
+
+            with self.items_lock:
+                with open(temp_file, "a") as manifest_fd:
+                    manifest_fd.writelines(self.manifest_pending)
+
+                if self.manifest_fd:
+                    self.manifest_fd.close()
+
+                os.rename(temp_file, self.manifest_file)
+                self.manifest_fd = open(self.manifest_file, "a")
+                self.manifest_lines = len(self.manifest_pending)
+        finally:
+            self.manifest_pending = None
+
+    def write_manifest_file(self, manifest_file, snapshot, classes, rates):
+        """
+        Write a snapshot of the cache contents to a manifest file. This method
+        is executed in the thread pool.
+
+        :param str manifest_file: Path to the file to write.
+        :param dict snapshot: Copy of the items.
+        :param dict classes: Copy of the cost class per item.
+        :param dict rates: Copy of the download rate per cost class.
+        """
+
+        with open(manifest_file, "w") as manifest_fd:
+            for cost_class, rate in rates.iteritems():
+                manifest_fd.write("~ %s %r\n" % (cost_class, rate))
+
+            for cache_key, cache_item in snapshot.iteritems():
+                if cache_item.size:
+                    manifest_fd.write(self.format_manifest_line(
+                        cache_key, cache_item, classes.get(cache_key)))
+
+    def format_manifest_line(self, cache_key, cache_item, cost_class):
+        """
+        Format the manifest line that adds or updates an item.
+        """
+
+        if cost_class:
+            return "+ %s %d %.0f %s\n" % (
+                cache_key, cache_item.size, cache_item.accessed, cost_class)
+
+        return "+ %s %d %.0f\n" % (
+            cache_key, cache_item.size, cache_item.accessed)
+
+    def compact_manifest(self, force=False):
+        """
+        Replace the manifest by the current cache contents, if enough changes
+        have been appended to it.
+
+        :param bool force: If true, always replace the manifest.
+        """
+
+        if force or self.manifest_lines >= max(
+                MANIFEST_COMPACT_LINES, len(self.items)):
+            self.write_manifest()
+
+    def journal(self, operation, cache_key, cache_item=None):
+        """
+        Append a change to the manifest. The change is flushed immediately,
+        so the manifest is correct after a crash.
+
+        :param str operation: Either `+` to add or update an item, `-` to
+                              remove an item, or `~` to record the download
+                              rate of the cost class given as `cache_key`.
+        """
+
+        if not self.manifest_fd:
+            return
+
+        if operation == "+":
+            line = self.format_manifest_line(
+                cache_key, cache_item, self.costs.classes.get(cache_key))
+        elif operation == "~":
+            line = "~ %s %r\n" % (cache_key, self.costs.rates[cache_key])
+        else:
+            line = "- %s\n" % cache_key
+
+        self.manifest_fd.write(line)
+        self.manifest_fd.flush()
+        self.manifest_lines += 1
+
+        # The manifest is being replaced, so record the change for the new
+        # manifest too.
+        if self.manifest_pending is not None:
+            self.manifest_pending.append(line)
+
+    def reconcile(self):
+        """
+        Compare the cache contents with the cache folder. Files that are not
+        in the cache are added, and items without file are removed. Only new
+        files are inspected, so this is a lot cheaper than indexing.
+        """
+
+        found = set()
+        added = removed = 0
+
+        for cache_key, cache_file in self.walk():
+            found.add(cache_key)
+
+            with self.items_lock:
+                if cache_key in self.items:
+                    continue
+
+            try:
+                stat = os.stat(cache_file)
+            except OSError:
+                continue
+
+            with self.items_lock:
+                if cache_key in self.items:
+                    continue
+
+                self.items[cache_key] = cache_item = FileCacheItem()
+
+                cache_item.size = stat.st_size
+                cache_item.accessed = stat.st_atime
+                cache_item.permanent = cache_key in self.permanent_cache_keys
+
+                if not cache_item.permanent:
+                    self.track(cache_key, cache_item)
+                    self.current_size += cache_item.size
+
+                self.journal("+", cache_key, cache_item)
+                added += 1
+
+        with self.items_lock:
+            for cache_key, cache_item in self.items.items():
+                # Items that are not loaded, but have a size, should have a
+                # file. Items that are being downloaded do not have one yet.
+                if cache_key in found or cache_item.ready is not None or \
+                        not cache_item.size:
+                    continue
+
+                if not cache_item.permanent:
+                    self.current_size -= cache_item.size
+
+                del self.items[cache_key]
+                self.policy.remove(cache_key)
+                self.idle.discard(cache_key)
+                self.journal("-", cache_key)
+                removed += 1
+
+        if added or removed:
+            logger.info(
+                "%s: Reconciled manifest with cache path: %d files added, %d "
+                "files removed.", self.name, added, removed)
+
+        self.write_manifest()
+
+    def walk(self):
+        """
+        Iterate over all files in the cache folder, yielding tuples of cache
+        key and cache file. Files that do not belong in the cache are skipped.
+        """
+
+        for root, directories, files in os.walk(self.path):
+            # Give other greenlets a chance to run during a long walk.
+            gevent.sleep(0)
+
+            for cache_file in files:
+                # Skip the manifest, and partial downloads that are resumed
+                # when the item is requested again.
+                if cache_file.startswith(".") or \
+                        cache_file.endswith((".temp", ".temp.extents")):
+                    continue
+
+                cache_file = os.path.join(root, cache_file)
+
+                try:
+                    cache_key = self.cache_file_to_cache_key(cache_file)
+                except ValueError:
+                    cache_key = None
+
+                if cache_key is None or \
+                        self.cache_key_to_cache_file(cache_key) != cache_file:
+                    logger.warning(
+                        "%s: Found unexpected file in cache path: %s",
+                        self.name, cache_file)
+                    continue
+
+                yield cache_key, cache_file
+
+    def migrate(self):
+        """
+        Move files of a flat cache folder into the sharded layout.
+        """
+
+        count = 0
+
+        for cache_file in os.listdir(self.path):
+            cache_file = os.path.join(self.path, cache_file)
+
+            if not os.path.isfile(cache_file) or \
+                    os.path.basename(cache_file).startswith("."):
+                continue
+
+            try:
+                cache_key = self.cache_file_to_cache_key(cache_file)
+            except ValueError:
+                continue
+
+            target_file = self.cache_key_to_cache_file(cache_key)
+
+            try:
+                self.create_cache_dir(target_file)
+                os.rename(cache_file, target_file)
+            except OSError as e:
+                logger.warning(
+                    "%s: Unable to move '%s' to sharded layout: %s",
+                    self.name, cache_file, e)
+                continue
+
+            count += 1
+
+        if count:
+            logger.info(
+                "%s: Moved %d files to sharded layout.", self.name, count)
+
     def cache_key_to_cache_file(self, cache_key):
         """
-        Get complete path to cache file, given a cache key.
+        Get complete path to cache file, given a cache key. Files are spread
+        over two levels of 256 folders each, based on the hash of the cache
+        key, so no single folder grows too large.
+
+        :param str cache_key:
+        """
+
+        cache_key = str(cache_key)
+        digest = hashlib.md5(cache_key).hexdigest()
+
+        return os.path.join(self.path, digest[0:2], digest[2:4], cache_key)
+
+    def has_partial(self, cache_key):
+        """
+        Return True if an interrupted download of a cache key has left a
+        partial file behind, which can be resumed.
 
         :param str cache_key:
         """
-        return os.path.join(self.path, str(cache_key))
+
+        return os.path.exists(
+            "%s.temp" % self.cache_key_to_cache_file(cache_key))
+
+    def create_cache_dir(self, cache_file):
+        """
+        Create the folder of a cache file, if it does not exist yet.
+
+        :param str cache_file:
+        """
+
+        directory = os.path.dirname(cache_file)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
 
     def cache_file_to_cache_key(self, cache_file):
         """
@@ -130,9 +657,8 @@ class FileCache(object):
         :param str cache_key:
         """
 
-        # Load item from cache. If it is found in cache, move it on top of the
-        # OrderedDict, so it is marked as most-recently accessed and therefore
-        # least likely to get pruned.
+        # Load item from cache. If it is found in cache, the eviction policy
+        # is notified of the access, which makes it less likely to get pruned.
         new_item = False
         wait_for_ready = True
 
@@ -144,11 +670,20 @@ class FileCache(object):
                 cache_item = self.items[cache_key]
                 del self.items[cache_key]
                 self.items[cache_key] = cache_item
+
+                if not cache_item.permanent:
+                    self.policy.access(cache_key)
             except KeyError:
                 self.items[cache_key] = cache_item = FileCacheItem()
                 cache_item.permanent = cache_key in self.permanent_cache_keys
                 new_item = True
 
+                if not cache_item.permanent:
+                    self.policy.add(cache_key)
+
+            cache_item.accessed = time.time()
+            self.handles.touch(self, cache_key)
+
             # The item can be either new, or it could be unloaded in the past.
             if cache_item.ready is None or cache_item.lock is None:
                 cache_item.ready = gevent.event.Event()
@@ -157,12 +692,34 @@ class FileCache(object):
 
             # The file is not in cache, but we allocated an instance so the
             # caller can load it. This is actually needed to prevent a second
-            # request from also loading it, hence cache_item not ready.
+            # request from also loading it, hence cache_item not ready. The
+            # item is claimed until the caller starts to download it.
             if new_item:
+                cache_item.claimed = gevent.event.Event()
                 return cache_item
 
+        # Another request claimed the item, but has not started to download
+        # it yet. Wait until it does, so the download can be tailed.
+        if cache_item.claimed is not None:
+            logger.debug(
+                "%s: waiting for item '%s' to be downloaded.", self.name,
+                cache_key)
+
+            if not cache_item.claimed.wait(timeout=TIMEOUT_WAIT_FOR_READY):
+                raise Exception("Waiting for cache item timed out.")
+
+            # The download could not be started, and the item was discarded.
+            # Claim it for this request instead.
+            if self.items.get(cache_key) is not cache_item:
+                return self.get(cache_key)
+
+        # Another request is downloading the file. The caller can tail the
+        # download, instead of waiting for it to finish.
+        if cache_item.downloading:
+            return cache_item
+
         # Wait until the cache_item is ready for use, e.g. another request is
-        # downloading the file.
+        # loading the file.
         if wait_for_ready:
             logger.debug(
                 "%s: waiting for item '%s' to be ready.", self.name, cache_key)
@@ -194,77 +751,208 @@ class FileCache(object):
         with self.items_lock:
             return cache_key in self.items
 
-    def expire(self):
-        """
-        Cleanup items (file descriptors etc.) that are not in use anymore.
+    def touch(self, cache_key):
         """
+        Mark an item as accessed without loading it, e.g. when it is served
+        from memory. This keeps the eviction policy informed of the access.
 
-        candidates = []
+        :param str cache_key:
+        :return: True if the item is in the cache.
+        """
 
         with self.items_lock:
-            for cache_key, cache_item in self.items.iteritems():
-                if cache_item.uses > 0:
-                    logger.debug(
-                        "%s: skipping file with key '%s' because it is %d "
-                        "times in use.", self.name, cache_key, cache_item.uses)
-                    continue
-
-                # Check if it is getting ready, e.g. one greenlet is
-                # downloading the file.
-                if cache_item.ready and not cache_item.ready.is_set():
-                    continue
+            cache_item = self.items.pop(cache_key, None)
 
-                # Item was ready and not in use, therefore clear the ready
-                # flag so no one will use it.
-                if cache_item.ready:
-                    cache_item.ready.clear()
+            if cache_item is None:
+                return False
 
-                    # Only unload items that have been ready.
-                    assert cache_item.iterator is not None
-                    candidates.append((cache_key, cache_item))
+            self.items[cache_key] = cache_item
 
-        for cache_key, cache_item in candidates:
-            self.unload(cache_key, cache_item)
+            if not cache_item.permanent:
+                self.policy.access(cache_key)
 
-            cache_item.iterator = None
-            cache_item.lock = None
-            cache_item.ready = None
+            cache_item.accessed = time.time()
 
-        if candidates:
-            logger.debug("%s: expired %d files", self.name, len(candidates))
+        return True
 
-    def clean(self, force=False):
+    def discard(self, cache_key):
         """
-        Prune items from the cache, if `self.current_size' exceeds
-        `self.max_size`. Only items that have been expired will be pruned,
-        unless it is marked as permanent.
-
-        :param bool force: If true, clean all items except permanent ones. This
-                           effectively removes all items from cache.
+        Forget an item that could not be downloaded, so the next request will
+        try again.
         """
 
-        candidates = []
+        with self.items_lock:
+            cache_item = self.items.pop(cache_key, None)
 
-        with self.prune_lock, self.items_lock:
-            # Check if cleanup is required.
-            if force:
-                logger.info(
-                    "%s: force cleaning all items from cache, except items "
-                    "that are in use or marked as permanent.", self.name)
-            else:
-                if not self.max_size or self.current_size < self.max_size:
+            if cache_item is None:
+                return
+
+            self.policy.remove(cache_key)
+            self.idle.discard(cache_key)
+
+            if not cache_item.permanent:
+                self.current_size -= cache_item.size
+
+        self.memory.remove(cache_key)
+        self.unclaim(cache_item)
+
+        logger.debug("%s: discarded item '%s'.", self.name, cache_key)
+
+    def use(self, cache_key, cache_item):
+        """
+        Mark an item as in use, e.g. when it starts streaming.
+        """
+
+        cache_item.uses += 1
+        self.idle.discard(cache_key)
+
+        logger.debug(
+            "%s: incremented '%s' use to %d.", self.name, cache_key,
+            cache_item.uses)
+
+    def release(self, cache_key, cache_item):
+        """
+        Mark an item as no longer in use by one user. Items that are not in use
+        anymore can be expired.
+        """
+
+        cache_item.uses -= 1
+
+        if not cache_item.uses and cache_item.ready is not None and \
+                cache_item.ready.is_set():
+            self.idle.add(cache_key)
+
+        logger.debug(
+            "%s: decremented '%s' use to %d.", self.name, cache_key,
+            cache_item.uses)
+
+    def set_ready(self, cache_key, cache_item):
+        """
+        Mark a loaded item as ready for use.
+        """
+
+        cache_item.ready.set()
+        self.unclaim(cache_item)
+
+        if not cache_item.uses:
+            self.idle.add(cache_key)
+
+    def unclaim(self, cache_item):
+        """
+        Wake up the requests that wait for a claimed item, e.g. because its
+        download has started.
+        """
+
+        if cache_item.claimed is not None:
+            cache_item.claimed.set()
+            cache_item.claimed = None
+
+    def expire(self):
+        """
+        Cleanup items (file descriptors etc.) that are not in use anymore.
+        Only items that are loaded and idle are considered.
+        """
+
+        candidates = []
+
+        with self.items_lock:
+            for cache_key in self.idle:
+                cache_item = self.items.get(cache_key)
+
+                # The item may have been removed, used or unloaded since it
+                # became idle.
+                if not self.is_idle(cache_item):
+                    continue
+
+                # Item was ready and not in use, therefore clear the ready
+                # flag so no one will use it.
+                cache_item.ready.clear()
+
+                # Only unload items that have been ready.
+                assert cache_item.iterator is not None
+                candidates.append((cache_key, cache_item))
+
+            self.idle.clear()
+
+        for cache_key, cache_item in candidates:
+            self.close_item(cache_key, cache_item)
+
+        if candidates:
+            logger.debug("%s: expired %d files", self.name, len(candidates))
+
+    def close(self, cache_key):
+        """
+        Unload a single item to release its file handles, if it is loaded and
+        not in use. It will be loaded again on the next request.
+
+        :param str cache_key:
+        :return: True if the item was unloaded.
+        """
+
+        with self.items_lock:
+            cache_item = self.items.get(cache_key)
+
+            if not self.is_idle(cache_item):
+                return False
+
+            cache_item.ready.clear()
+            self.idle.discard(cache_key)
+
+        self.close_item(cache_key, cache_item)
+        return True
+
+    def is_idle(self, cache_item):
+        """
+        Return True if an item is loaded and not in use.
+        """
+
+        return cache_item is not None and cache_item.uses == 0 and \
+            cache_item.ready is not None and cache_item.ready.is_set()
+
+    def close_item(self, cache_key, cache_item):
+        """
+        Unload an item of which the ready flag has been cleared.
+        """
+
+        self.unload(cache_key, cache_item)
+        self.handles.remove(self, cache_key)
+
+        cache_item.iterator = None
+        cache_item.lock = None
+        cache_item.ready = None
+
+    def clean(self, force=False):
+        """
+        Prune items from the cache, if `self.current_size' exceeds
+        `self.max_size`. Only items that have been expired will be pruned,
+        unless it is marked as permanent. Pruned items are removed from memory
+        too.
+
+        :param bool force: If true, clean all items except permanent ones. This
+                           effectively removes all items from cache.
+        """
+
+        candidates = []
+
+        with self.prune_lock, self.items_lock:
+            # Check if cleanup is required.
+            if force:
+                logger.info(
+                    "%s: force cleaning all items from cache, except items "
+                    "that are in use or marked as permanent.", self.name)
+            else:
+                if not self.max_size or self.current_size < self.max_size:
                     return
 
-            # Determine candidates to remove.
-            for cache_key, cache_item in self.items.iteritems():
+            # Determine candidates to remove, in the order of the eviction
+            # policy. Permanent items are not known to the policy.
+            for cache_key in self.policy.candidates():
                 if not force:
                     if self.current_size < \
                             (self.max_size * (1.0 - self.prune_threshold)):
                         break
 
-                # keep permanent items
-                if cache_item.permanent:
-                    continue
+                cache_item = self.items[cache_key]
 
                 # If `cache_item.ready` is not set, it is not loaded into
                 # memory.
@@ -272,12 +960,17 @@ class FileCache(object):
                     candidates.append((cache_key, cache_item))
                     self.current_size -= cache_item.size
 
-                    del self.items[cache_key]
+            for cache_key, cache_item in candidates:
+                del self.items[cache_key]
+                self.policy.evict(cache_key)
+                self.costs.forget(cache_key)
 
         # Actual removal of the files. At this point, the cache_item is not in
         # `self.items` anymore. No other greenlet can retrieve it anymore.
         for cache_key, cache_item in candidates:
             cache_file = self.cache_key_to_cache_file(cache_key)
+            self.journal("-", cache_key)
+            self.memory.remove(cache_key)
 
             try:
                 os.remove(cache_file)
@@ -306,8 +999,35 @@ class FileCache(object):
                 self.current_size += file_size
 
             cache_item.size = file_size
+            self.journal("+", cache_key, cache_item)
+
+        if not cache_item.permanent:
+            cost = self.costs.estimate(cache_key, file_size)
+            self.policy.weigh(cache_key, file_size, cost)
+
+    def measure(self, cache_key, cost_class, elapsed, file_size):
+        """
+        Record a completed download, to estimate the cost of downloading it
+        again. The rate of its cost class is added to the manifest, so it is
+        known after a restart.
+        """
+
+        self.costs.measure(cache_key, cost_class, elapsed, file_size)
+
+        if cost_class in self.costs.rates:
+            self.journal("~", cost_class)
+
+    def download(self, cache_key, cache_item, remote_fd, on_cached=None,
+                 cost_class=None):
+        """
+        Download an item, while streaming it.
+
+        :param callable on_cached: Method that is invoked with the file size,
+                                   once the item is downloaded completely.
+        :param str cost_class: Class of the download, to measure the cost of
+                               downloading it again.
+        """
 
-    def download(self, cache_key, cache_item, remote_fd):
         start = time.time()
 
         def on_cache(file_size):
@@ -321,28 +1041,151 @@ class FileCache(object):
                 cache_key, time.time() - start)
 
             remote_fd.close()
+            self.measure(cache_key, cost_class, time.time() - start, file_size)
             self.load(cache_key, cache_item)
+            cache_item.downloading = False
+
+            if on_cached:
+                on_cached(file_size)
+
+        def on_error(e):
+            """
+            Executed when the download failed.
+            """
+
+            logger.warning(
+                "%s: downloading '%s' failed: %s", self.name, cache_key, e)
+
+            remote_fd.close()
+            cache_item.downloading = False
+            self.discard(cache_key)
 
         cache_file = self.cache_key_to_cache_file(cache_key)
+        self.create_cache_dir(cache_file)
+
+        cache_item.downloading = True
         cache_item.iterator = stream.stream_from_remote(
-            cache_item.lock, remote_fd, cache_file, on_cache=on_cache)
+            cache_item.lock, remote_fd, cache_file, on_cache=on_cache,
+            on_error=on_error, max_chunk_size=self.max_chunk_size)
+        self.unclaim(cache_item)
+
+    def download_ranged(self, cache_key, cache_item, remote_fd_factory,
+                        file_size, cost_class=None):
+        """
+        Download an item with ranged requests into a sparse file, so that any
+        byte range can be served as soon as it has been downloaded.
+
+        :param callable remote_fd_factory: Method that is invoked with a tuple
+                                           of (begin, end) and should return
+                                           a file descriptor of that range.
+        :param int file_size: Expected size of the item, in bytes.
+        :param str cost_class: Class of the download, to measure the cost of
+                               downloading it again.
+        """
+
+        start = time.time()
+
+        def on_cache(file_size):
+            """
+            Executed when all segments are downloaded. This method is executed
+            with the `cache_item` locked.
+            """
+
+            logger.debug(
+                "%s: downloading '%s' took %.2f seconds.", self.name,
+                cache_key, time.time() - start)
+
+            self.measure(cache_key, cost_class, time.time() - start, file_size)
+            self.load(cache_key, cache_item)
+            cache_item.downloading = False
+
+        def on_error(e):
+            """
+            Executed when the download failed. The partial file is kept, so
+            the next request resumes the download.
+            """
+
+            logger.warning(
+                "%s: downloading '%s' failed: %s", self.name, cache_key, e)
+
+            cache_item.downloading = False
+            self.discard(cache_key)
+
+        cache_file = self.cache_key_to_cache_file(cache_key)
+        self.create_cache_dir(cache_file)
+
+        cache_item.downloading = True
+        cache_item.iterator = stream.stream_from_remote_ranged(
+            cache_item.lock, remote_fd_factory, cache_file, file_size,
+            on_cache=on_cache, on_error=on_error)
+        self.unclaim(cache_item)
 
 
 class ArtworkCache(FileCache):
+    def __init__(self, path, max_size, prune_threshold, sizes=None,
+                 **kwargs):
+        """
+        Construct a new artwork cache.
+
+        :param list sizes: Sizes (in pixels) of the artwork variants that can
+                           be requested, or None to always use the original.
+        """
+
+        super(ArtworkCache, self).__init__(
+            path, max_size, prune_threshold, **kwargs)
+
+        self.sizes = sorted(sizes or [])
+
+    def get_size(self, width, height):
+        """
+        Get the smallest artwork size that covers the requested dimensions.
+        Returns None if the original artwork should be used, either because no
+        dimensions are given, or because they exceed the largest size.
+
+        :param int width: Requested width in pixels, or None.
+        :param int height: Requested height in pixels, or None.
+        """
+
+        requested = max(width or 0, height or 0)
+
+        if not requested:
+            return
+
+        for size in self.sizes:
+            if size >= requested:
+                return size
+
+    def cache_file_to_cache_key(self, cache_file):
+        """
+        Get cache key, given a cache file. Artwork shared by an album has a
+        prefixed key, and size variants have a suffix. The original artwork of
+        an item is keyed by item ID.
+
+        :param str cache_file:
+        """
+
+        cache_key = os.path.basename(cache_file)
+        parts = cache_key.split("-")
+
+        if parts[0] + "-" == ARTWORK_ALBUM_PREFIX:
+            parts = parts[1:]
+
+        if not 1 <= len(parts) <= 2:
+            raise ValueError("Invalid artwork cache key: %s" % cache_key)
+
+        # Validate the numeric parts.
+        map(int, parts)
+
+        if cache_key.isdigit():
+            return int(cache_key)
+
+        return cache_key
+
     def load(self, cache_key, cache_item):
         cache_file = self.cache_key_to_cache_file(cache_key)
 
-        def on_start():
-            cache_item.uses += 1
-            logger.debug(
-                "%s: incremented '%s' use to %d", self.name, cache_key,
-                cache_item.uses)
-
-        def on_finish():
-            cache_item.uses -= 1
-            logger.debug(
-                "%s: decremented '%s' use to %d", self.name, cache_key,
-                cache_item.uses)
+        on_start = partial(self.use, cache_key, cache_item)
+        on_finish = partial(self.release, cache_key, cache_item)
 
         file_size = os.stat(cache_file).st_size
         cache_item.data = local_fd = open(cache_file, "rb")
@@ -350,10 +1193,15 @@ class ArtworkCache(FileCache):
         # Update cache item
         self.update(cache_key, cache_item, cache_file, file_size)
 
+        # Keep a copy in memory, so next requests do not hit the disk.
+        if self.memory.max_size:
+            self.memory.put(cache_key, local_fd.read())
+
         cache_item.iterator = stream.stream_from_file(
             cache_item.lock, local_fd, file_size,
             on_start=on_start, on_finish=on_finish)
-        cache_item.ready.set()
+        self.handles.add(self, cache_key)
+        self.set_ready(cache_key, cache_item)
 
     def unload(self, cache_key, cache_item):
         if cache_item.data:
@@ -362,80 +1210,758 @@ class ArtworkCache(FileCache):
 
 
 class ItemCache(FileCache):
+    def __init__(self, path, max_size, prune_threshold, **kwargs):
+        """
+        Construct a new item cache.
+        """
+
+        super(ItemCache, self).__init__(
+            path, max_size, prune_threshold, **kwargs)
+
+        self.frequencies = {}
+        self.accesses = 0
+
+        # Bytes served per tier: memory, disk or remote.
+        self.served = {"memory": 0, "disk": 0, "remote": 0}
+
+    def get_memory(self, cache_key, played=True):
+        """
+        Get the data of an item from memory, or None if it is not in memory.
+        The play frequency of the item is updated, to decide which items are
+        kept in memory.
+
+        :param str cache_key:
+        :param bool played: False if the request continues a play, e.g. when
+                            seeking, so it does not count as a play.
+        """
+
+        if not self.memory.max_size:
+            return
+
+        if not played:
+            return self.memory.get(cache_key)
+
+        self.frequencies[cache_key] = self.frequencies.get(cache_key, 0) + 1
+        self.accesses += 1
+
+        if self.accesses >= MEMORY_AGING_ACCESSES:
+            self.accesses = 0
+
+            for key, frequency in self.frequencies.items():
+                if frequency > 1:
+                    self.frequencies[key] = frequency / 2
+                else:
+                    del self.frequencies[key]
+
+        return self.memory.get(cache_key)
+
+    def promote(self, cache_key, cache_item):
+        """
+        Copy a loaded item into memory, if it is played often enough and is
+        small enough. The items that would be evicted to make room must be
+        played less often, otherwise the item is not promoted. Items are
+        demoted by the least recently used order of the memory cache.
+
+        :param str cache_key:
+        :param FileCacheItem cache_item:
+        """
+
+        frequency = self.frequencies.get(cache_key, 0)
+
+        if frequency < MEMORY_PROMOTE_ACCESSES or \
+                cache_key in self.memory.items or cache_item.data is None or \
+                cache_item.size > self.memory.max_size / 8:
+            return
+
+        free = self.memory.max_size - self.memory.current_size
+
+        for victim_key, victim_data in self.memory.items.iteritems():
+            if free >= cache_item.size:
+                break
+
+            if self.frequencies.get(victim_key, 0) > frequency:
+                return
+
+            free += len(victim_data)
+
+        _, mmap_fd = cache_item.data
+        self.memory.put(cache_key, mmap_fd[:])
+
+        logger.debug(
+            "%s: promoted item '%s' to memory, %s of %s used.", self.name,
+            cache_key, human_bytes(self.memory.current_size),
+            human_bytes(self.memory.max_size))
+
+    def count_served(self, tier, byte_range, file_size):
+        """
+        Account for bytes served from a tier.
+
+        :param str tier: Either memory, disk or remote.
+        :param tuple byte_range: Requested byte range, if any.
+        :param int file_size: Size of the item, or -1 if unknown.
+        """
+
+        if file_size < 0:
+            return
+
+        begin, end = parse_byte_range(byte_range, max_byte=file_size)
+        self.served[tier] += max(0, end - begin)
+
+    def cache_file_to_cache_key(self, cache_file):
+        """
+        Get cache key, given a cache file. Original items are keyed by item
+        ID, transcoded items by item ID, format and bitrate.
+
+        :param str cache_file:
+        """
+
+        cache_key = os.path.basename(cache_file)
+
+        if cache_key.isdigit():
+            return int(cache_key)
+
+        parts = cache_key.split("-")
+
+        if len(parts) != 3 or not parts[0].isdigit() or \
+                not parts[1].isalnum() or not parts[2].isdigit():
+            raise ValueError("Invalid item cache key: %s" % cache_key)
+
+        return cache_key
+
     def load(self, cache_key, cache_item):
         cache_file = self.cache_key_to_cache_file(cache_key)
 
-        def on_start():
-            cache_item.uses += 1
-            logger.debug(
-                "%s: incremented '%s' use to %d.", self.name, cache_key,
-                cache_item.uses)
-
-        def on_finish():
-            cache_item.uses -= 1
-            logger.debug(
-                "%s: decremented '%s' use to %d.", self.name, cache_key,
-                cache_item.uses)
+        on_start = partial(self.use, cache_key, cache_item)
+        on_finish = partial(self.release, cache_key, cache_item)
 
         file_size = os.stat(cache_file).st_size
 
         local_fd = open(cache_file, "r+b")
         mmap_fd = mmap.mmap(local_fd.fileno(), 0, prot=mmap.PROT_READ)
+
+        # Items are streamed from start to end, so let the kernel read ahead
+        # more aggressively.
+        stream.fadvise(local_fd.fileno(), 0, 0, stream.FADV_SEQUENTIAL)
         cache_item.data = local_fd, mmap_fd
 
         # Update cache item
         self.update(cache_key, cache_item, cache_file, file_size)
 
         cache_item.iterator = stream.stream_from_buffer(
-            cache_item.lock, mmap_fd, file_size,
-            on_start=on_start, on_finish=on_finish)
-        cache_item.ready.set()
+            mmap_fd, file_size, fd=local_fd.fileno(),
+            on_start=on_start, on_finish=on_finish,
+            max_chunk_size=self.max_chunk_size)
+
+        # The memory map holds a duplicate of the file descriptor.
+        self.handles.add(self, cache_key, count=2)
+        self.set_ready(cache_key, cache_item)
 
     def unload(self, cache_key, cache_item):
-        if cache_item.data:
-            local_fd, mmap_fd = cache_item.data
+        # Readers do not lock the memory mapped file. It is only unloaded
+        # when it is not in use, and the lock guards the transition.
+        with cache_item.lock:
+            if cache_item.data:
+                local_fd, mmap_fd = cache_item.data
 
-            mmap_fd.close()
-            local_fd.close()
+                mmap_fd.close()
+                local_fd.close()
 
-            cache_item.data = None
+                cache_item.data = None
+
+
+class HeadCache(FileCache):
+    """
+    Cache of the first bytes (the head) of items. When an item that is not in
+    the item cache starts playing, its head is copied into a partial item
+    file. Playback starts from the head, while the remainder is downloaded
+    with ranged requests.
+    """
+
+    def cache_file_to_cache_key(self, cache_file):
+        """
+        Get cache key, given a cache file. Heads are keyed by item ID.
+
+        :param str cache_file:
+        """
+
+        return int(os.path.basename(cache_file))
+
+    def get_head(self, cache_key):
+        """
+        Get the file of a head, or None if it is not in the cache. The head is
+        marked as accessed.
+
+        :param int cache_key:
+        """
+
+        if not self.touch(cache_key):
+            return
+
+        return self.cache_key_to_cache_file(cache_key)
+
+    def put(self, cache_key, data):
+        """
+        Store the head of an item. The file is written in the thread pool.
+
+        :param int cache_key:
+        :param str data: First bytes of the item.
+        """
+
+        cache_file = self.cache_key_to_cache_file(cache_key)
+        temp_file = "%s.temp" % cache_file
+        self.create_cache_dir(cache_file)
+
+        with open(temp_file, "wb") as local_fd:
+            gevent.get_hub().threadpool.apply(local_fd.write, (data, ))
+
+        stream.move_file(temp_file, cache_file)
+
+        with self.items_lock:
+            cache_item = self.items.get(cache_key)
+
+            if cache_item is None:
+                self.items[cache_key] = cache_item = FileCacheItem()
+                self.policy.add(cache_key)
+
+            cache_item.accessed = time.time()
+
+        self.update(cache_key, cache_item, cache_file, len(data))
 
 
 class CacheManager(object):
     """
     """
 
-    def __init__(self, db, item_cache, artwork_cache, connections):
+    def __init__(self, db, item_cache, artwork_cache, connections,
+                 concurrency=1, bandwidth=0, head_cache=None, head_seconds=0,
+                 head_containers=None, popular_size=0):
+        """
+        Construct a new cache manager.
+
+        :param int concurrency: Number of permanent items to download at the
+                                same time.
+        :param int bandwidth: Maximum download rate (in KB/s) for permanent
+                              items, or 0 for unlimited.
+        :param HeadCache head_cache: Cache for the heads of items, or None to
+                                     disable.
+        :param int head_seconds: Length (in seconds) of the head of an item.
+        :param list head_containers: Names of the containers of which the
+                                     heads of all items are cached.
+        :param int popular_size: Maximum size (in MB) of the most played items
+                                 that are permanently cached, or 0 to disable.
+        """
+
         self.db = db
         self.item_cache = item_cache
         self.artwork_cache = artwork_cache
+        self.head_cache = head_cache
+        self.head_seconds = head_seconds
+        self.head_containers = head_containers or []
+        self.popular_size = popular_size * 1024 * 1024
         self.connections = connections
 
+        # Plays that have not been written to the database yet.
+        self.plays = {}
+        self.plays_writer = None
+
+        # Sizes of transcoded items that have not been written to the
+        # database yet.
+        self.transcoded_sizes = {}
+        self.transcoded_sizes_writer = None
+
+        self.warmer = CacheWarmer(
+            concurrency=concurrency, bandwidth=bandwidth,
+            on_idle=self.expire)
+
         self.setup_index()
 
     def setup_index(self):
         """
         """
 
-        cached_items = self.get_cached_items()
+        self.artwork_cache.migrate()
+        self.item_cache.migrate()
+
+        # Caches with a manifest have been migrated before.
+        if not self.artwork_cache.has_manifest():
+            self.migrate_artwork()
 
-        self.artwork_cache.index(cached_items)
+        cached_artwork, cached_items = self.get_permanent_cache_keys(
+            self.get_cached_items())
+
+        self.artwork_cache.index(cached_artwork)
         self.item_cache.index(cached_items)
 
+        if self.head_cache:
+            self.head_cache.index(set())
+
+    def migrate_artwork(self):
+        """
+        Artwork used to be cached per item. Move artwork of items that belong
+        to an album with artwork to the shared album entry, and remove the
+        duplicates.
+        """
+
+        item_ids = [
+            cache_key for cache_key, _ in self.artwork_cache.walk()
+            if isinstance(cache_key, int)]
+
+        if not item_ids:
+            return
+
+        moved = removed = 0
+
+        with self.db.get_cursor() as cursor:
+            rows = cursor.query(
+                """
+                SELECT
+                    `items`.`id`,
+                    `items`.`album_id`
+                FROM
+                    `items`
+                INNER JOIN
+                    `albums` ON `items`.`album_id` = `albums`.`id`
+                WHERE
+                    `albums`.`art` = 1 AND
+                    `items`.`id` IN (%s)
+                """ % in_list(item_ids)).fetchall()
+
+        for row in rows:
+            cache_file = self.artwork_cache.cache_key_to_cache_file(row["id"])
+            album_file = self.artwork_cache.cache_key_to_cache_file(
+                artwork_cache_key(row["id"], row["album_id"], True))
+
+            try:
+                if os.path.exists(album_file):
+                    os.remove(cache_file)
+                    removed += 1
+                else:
+                    self.artwork_cache.create_cache_dir(album_file)
+                    os.rename(cache_file, album_file)
+                    moved += 1
+            except OSError as e:
+                logger.warning(
+                    "Unable to migrate artwork of item '%d': %s",
+                    row["id"], e)
+
+        if moved or removed:
+            logger.info(
+                "Migrated artwork to shared album artwork: %d files moved, "
+                "%d duplicates removed.", moved, removed)
+
+    def get_permanent_cache_keys(self, cached_items):
+        """
+        Get the cache keys of the artwork and the items of permanently cached
+        items. Clients request artwork of a certain size, so the original and
+        all size variants of the artwork are permanent.
+
+        :return: Tuple of (artwork cache keys, item cache keys).
+        :rtype: tuple
+        """
+
+        cached_artwork = set(
+            artwork_cache_key(
+                item_id, cached_item["album_id"], cached_item["album_art"],
+                size)
+            for item_id, cached_item in cached_items.iteritems()
+            for size in [None] + self.artwork_cache.sizes)
+        cached_items = set(
+            self.get_item_cache_key(item_id, cached_item)
+            for item_id, cached_item in cached_items.iteritems())
+
+        return cached_artwork, cached_items
+
+    def get_item_cache_key(self, item_id, cached_item):
+        """
+        Get the item cache key of a permanently cached item, which depends on
+        the transcode settings of its connection.
+        """
+
+        connection = self.connections.get(cached_item["database_id"])
+
+        if connection is None:
+            return item_id
+
+        return connection.get_item_cache_key(
+            item_id, cached_item["file_suffix"])
+
+    def get_resumable_size(self, cache_key, cached_item):
+        """
+        Get the size of a permanently cached item, if an interrupted download
+        of it can be resumed. Transcoded items cannot be resumed.
+        """
+
+        if isinstance(cache_key, (int, long)):
+            return cached_item["file_size"]
+
+    def on_item_cached(self, cache_key, head_size=0):
+        """
+        Get the method to invoke when an item is downloaded completely. For
+        transcoded items, it records the size of the transcode, so later
+        requests can be answered with an exact size. For other items, the
+        head is kept, so it can start playing instantly after the item is
+        pruned.
+
+        :param str cache_key: Item cache key.
+        :param int head_size: Size of the head of the item, see
+                              `get_head_size`.
+        """
+
+        if isinstance(cache_key, basestring):
+            return partial(self.set_transcoded_size, cache_key)
+
+        if head_size and self.head_cache and \
+                not self.head_cache.contains(cache_key):
+            return partial(self.save_head, cache_key, head_size)
+
+    def get_head_size(self, file_size, duration):
+        """
+        Get the number of bytes of the head of an item. Heads are rounded up to
+        whole segments, so a ranged download can reuse them.
+
+        :param int file_size: Size of the item, in bytes.
+        :param int duration: Duration of the item (in ms), if known.
+        :return: Size of the head, or 0 if heads are disabled.
+        :rtype: int
+        """
+
+        if not self.head_cache or not file_size:
+            return 0
+
+        if duration:
+            head_size = file_size * self.head_seconds * 1000 / duration
+        else:
+            head_size = 0
+
+        segments = max(
+            1, (head_size + stream.SEGMENT_SIZE - 1) // stream.SEGMENT_SIZE)
+
+        return min(file_size, segments * stream.SEGMENT_SIZE)
+
+    def save_head(self, cache_key, head_size, file_size):
+        """
+        Copy the head of an item that has been downloaded completely into the
+        head cache.
+        """
+
+        cache_file = self.item_cache.cache_key_to_cache_file(cache_key)
+
+        with open(cache_file, "rb") as local_fd:
+            data = gevent.get_hub().threadpool.apply(
+                local_fd.read, (head_size, ))
+
+        self.head_cache.put(cache_key, data)
+
+    def seed_item(self, cache_key):
+        """
+        Copy the head of an item into a partial item file, so a ranged
+        download of the item starts from the head.
+
+        :param int cache_key: Item cache key.
+        :return: True if the head was copied.
+        :rtype: bool
+        """
+
+        if not self.head_cache or not isinstance(cache_key, (int, long)):
+            return False
+
+        head_file = self.head_cache.get_head(cache_key)
+
+        if head_file is None:
+            return False
+
+        cache_file = self.item_cache.cache_key_to_cache_file(cache_key)
+        self.item_cache.create_cache_dir(cache_file)
+
+        try:
+            gevent.get_hub().threadpool.apply(
+                shutil.copyfile, (head_file, "%s.temp" % cache_file))
+        except IOError as e:
+            logger.warning(
+                "Unable to copy head of item '%s': %s", cache_key, e)
+            return False
+
+        logger.debug("Seeded item '%s' from its head.", cache_key)
+        return True
+
+    def cache_head(self, cache_key, get_fd, remote_id, file_suffix, head_size,
+                   limit=None):
+        """
+        Download the head of an item into the head cache.
+
+        :param callable get_fd: Method of the connection that returns the
+                                remote file descriptor.
+        :param int head_size: Number of bytes to download.
+        :param callable limit: Method that applies a bandwidth cap to the
+                               remote file descriptor, if any.
+        """
+
+        remote_fd = get_fd(
+            remote_id, file_suffix, byte_range=(0, head_size),
+            priority=downloads.BACKGROUND)
+
+        if limit:
+            remote_fd = limit(remote_fd)
+
+        chunks = []
+        remaining = head_size
+
+        try:
+            while remaining > 0:
+                chunk = remote_fd.read(min(remaining, 65536))
+
+                if not chunk:
+                    break
+
+                chunks.append(chunk)
+                remaining -= len(chunk)
+        finally:
+            remote_fd.close()
+
+        # A head that is cut short cannot be reused.
+        if remaining:
+            raise IOError("Remote file ended before the head was complete.")
+
+        self.head_cache.put(cache_key, "".join(chunks))
+
+    def get_head_items(self):
+        """
+        Get all items of the containers of which the heads should be cached.
+        """
+
+        with self.db.get_cursor() as cursor:
+            return cursor.query_dict(
+                """
+                SELECT DISTINCT
+                    `items`.`id`,
+                    `items`.`database_id`,
+                    `items`.`remote_id`,
+                    `items`.`file_suffix`,
+                    `items`.`file_size`,
+                    `items`.`duration`
+                FROM
+                    `container_items`
+                INNER JOIN
+                    `containers` ON
+                        `container_items`.`container_id` = `containers`.`id`
+                INNER JOIN
+                    `items` ON `container_items`.`item_id` = `items`.`id`
+                WHERE
+                    `containers`.`name` IN (%s) AND
+                    `items`.`exclude` = 0
+                """ % ",".join("?" * len(self.head_containers)),
+                *self.head_containers)
+
+    def get_transcoded_size(self, cache_key):
+        """
+        Get the size of a transcoded item, if it has been transcoded
+        completely before. Returns None otherwise.
+
+        :param str cache_key: Item cache key of the transcoded item.
+        """
+
+        if cache_key in self.transcoded_sizes:
+            return self.transcoded_sizes[cache_key]
+
+        with self.db.get_cursor() as cursor:
+            row = cursor.query_one(
+                """
+                SELECT
+                    `transcodes`.`file_size`
+                FROM
+                    `transcodes`
+                WHERE
+                    `transcodes`.`cache_key` = ?
+                """, cache_key)
+
+        if row:
+            return row["file_size"]
+
+    def set_transcoded_size(self, cache_key, file_size):
+        """
+        Record the size of a transcoded item. The size is written to the
+        database in the background, because this method is invoked with the
+        cache item locked.
+
+        :param str cache_key: Item cache key of the transcoded item.
+        :param int file_size: Size of the transcoded item, in bytes.
+        """
+
+        self.transcoded_sizes[cache_key] = file_size
+
+        if self.transcoded_sizes_writer is None or \
+                self.transcoded_sizes_writer.dead:
+            self.transcoded_sizes_writer = gevent.spawn(
+                self.write_transcoded_sizes)
+
+    def write_transcoded_sizes(self):
+        """
+        Write the recorded sizes of transcoded items to the database, until
+        there are no more sizes left.
+        """
+
+        while self.transcoded_sizes:
+            transcoded_sizes = dict(self.transcoded_sizes)
+
+            try:
+                with self.db.get_write_cursor() as cursor:
+                    for cache_key, file_size in transcoded_sizes.iteritems():
+                        cursor.query(
+                            """
+                            INSERT OR REPLACE INTO `transcodes` (
+                                `cache_key`,
+                                `file_size`)
+                            VALUES
+                                (?, ?)
+                            """, cache_key, file_size)
+            except Exception as e:
+                logger.warning(
+                    "Unable to record %d transcoded sizes: %s",
+                    len(transcoded_sizes), e)
+
+            # Sizes are kept until written, so they can be looked up in the
+            # meantime. Only forget the ones that did not change.
+            for cache_key, file_size in transcoded_sizes.iteritems():
+                if self.transcoded_sizes.get(cache_key) == file_size:
+                    del self.transcoded_sizes[cache_key]
+
+    def record_play(self, item_id):
+        """
+        Record that an item started playing, to determine the popular items.
+        The play is written to the database in the background, because the
+        database may be locked by a synchronization for a long time.
+
+        :param int item_id: ID of the item.
+        """
+
+        play_count, _ = self.plays.get(item_id, (0, 0))
+        self.plays[item_id] = play_count + 1, int(time.time())
+
+        if self.plays_writer is None or self.plays_writer.dead:
+            self.plays_writer = gevent.spawn(self.write_plays)
+
+    def write_plays(self):
+        """
+        Write the recorded plays to the database, until there are no more
+        plays left.
+        """
+
+        while self.plays:
+            plays, self.plays = self.plays, {}
+
+            try:
+                with self.db.get_write_cursor() as cursor:
+                    for item_id, (play_count, last_played) in \
+                            plays.iteritems():
+                        cursor.query(
+                            """
+                            INSERT OR IGNORE INTO `plays` (
+                                `item_id`,
+                                `play_count`,
+                                `last_played`)
+                            VALUES
+                                (?, 0, 0)
+                            """, item_id)
+                        cursor.query(
+                            """
+                            UPDATE
+                                `plays`
+                            SET
+                                `play_count` = `play_count` + ?,
+                                `last_played` = ?
+                            WHERE
+                                `item_id` = ?
+                            """, play_count, last_played, item_id)
+            except Exception as e:
+                logger.warning("Unable to record %d plays: %s", len(plays), e)
+
+    def get_popular_items(self):
+        """
+        Get the most played items that fit in the popular items budget. Plays
+        count less as they get older, so items that are not played anymore
+        make room for new favorites.
+        """
+
+        if not self.popular_size:
+            return {}
+
+        with self.db.get_cursor() as cursor:
+            played_items = cursor.query_dict(
+                """
+                SELECT
+                    `items`.`id`,
+                    `items`.`database_id`,
+                    `items`.`remote_id`,
+                    `items`.`file_suffix`,
+                    `items`.`file_size`,
+                    `items`.`album_id`,
+                    `albums`.`art` AS `album_art`,
+                    `albums`.`art_name` AS `album_art_id`,
+                    `plays`.`play_count`,
+                    `plays`.`last_played`
+                FROM
+                    `plays`
+                INNER JOIN
+                    `items` ON `plays`.`item_id` = `items`.`id`
+                LEFT OUTER JOIN
+                    `artists` ON `items`.`artist_id`=`artists`.`id`
+                LEFT OUTER JOIN
+                    `artists` AS `album_artists` ON
+                        `items`.`album_artist_id` = `album_artists`.`id`
+                LEFT OUTER JOIN
+                    `albums` ON `items`.`album_id`=`albums`.`id`
+                WHERE
+                    `plays`.`play_count` >= ? AND
+                    `items`.`exclude` = 0 AND
+                    COALESCE(`artists`.`exclude`, 0) = 0 AND
+                    COALESCE(`album_artists`.`exclude`, 0) = 0 AND
+                    COALESCE(`albums`.`exclude`, 0) = 0
+                """, POPULAR_MIN_PLAYS)
+
+        now = time.time()
+
+        def _score(item_id):
+            played_item = played_items[item_id]
+            age = max(0, now - played_item["last_played"])
+
+            return played_item["play_count"] * 0.5 ** (
+                float(age) / POPULAR_HALF_LIFE)
+
+        popular_items = {}
+        budget = self.popular_size
+
+        for item_id in sorted(played_items, key=_score, reverse=True):
+            file_size = played_items[item_id]["file_size"] or 0
+
+            if file_size > budget:
+                continue
+
+            budget -= file_size
+            popular_items[item_id] = played_items[item_id]
+
+        return popular_items
+
     def get_cached_items(self):
         """
         Get all items that should be permanently cached, independent of which
-        database.
+        database. These are the items that are marked for caching, and the
+        popular items.
         """
 
+        popular_items = self.get_popular_items()
+
         with self.db.get_cursor() as cursor:
-            return cursor.query_dict(
+            cached_items = cursor.query_dict(
                 """
                 SELECT
                     `items`.`id`,
                     `items`.`database_id`,
                     `items`.`remote_id`,
-                    `items`.`file_suffix`
+                    `items`.`file_suffix`,
+                    `items`.`file_size`,
+                    `items`.`album_id`,
+                    `albums`.`art` AS `album_art`,
+                    `albums`.`art_name` AS `album_art_id`
                 FROM
                     `items`
                 LEFT OUTER JOIN
@@ -458,49 +1984,201 @@ class CacheManager(object):
                     COALESCE(`albums`.`exclude`, 0) = 0
                 """)
 
+        popular_items.update(cached_items)
+        return popular_items
+
     def cache(self):
         """
-        Update the caches with all items that should be permanently cached.
+        Queue all items that should be permanently cached, but are not in the
+        caches yet. The items are downloaded in the background. The set of
+        permanent items is updated first, since items may have been marked for
+        caching or may have become popular.
         """
 
         cached_items = self.get_cached_items()
-        logger.info("Caching %d permanent items.", len(cached_items))
+        count = 0
+
+        cached_artwork, cached_item_keys = self.get_permanent_cache_keys(
+            cached_items)
+
+        self.artwork_cache.pin(cached_artwork)
+        self.item_cache.pin(cached_item_keys)
 
         for item_id in cached_items:
             database_id = cached_items[item_id]["database_id"]
             remote_id = cached_items[item_id]["remote_id"]
             file_suffix = cached_items[item_id]["file_suffix"]
+            album_art_id = cached_items[item_id]["album_art_id"]
 
-            # Artwork
-            if item_id not in self.artwork_cache.items:
-                logger.debug("Artwork with key '%d' not in cache.", item_id)
-                cache_item = self.artwork_cache.get(item_id)
+            # Artwork, the original and each size variant.
+            for size in [None] + self.artwork_cache.sizes:
+                artwork_key = artwork_cache_key(
+                    item_id, cached_items[item_id]["album_id"],
+                    cached_items[item_id]["album_art"], size)
 
-                if not cache_item.ready.is_set():
-                    remote_fd = self.connections[database_id].get_artwork_fd(
-                        remote_id, file_suffix)
-                    self.artwork_cache.download(item_id, cache_item, remote_fd)
+                if artwork_key in self.artwork_cache.items:
+                    continue
 
-                    # Exhaust iterator so it downloads the artwork.
-                    exhaust(cache_item.iterator())
+                logger.debug(
+                    "Artwork with key '%s' not in cache.", artwork_key)
+                self.warmer.enqueue(
+                    "artwork-%s" % artwork_key, partial(
+                        self.cache_file, self.artwork_cache, artwork_key,
+                        partial(
+                            self.connections[database_id].get_artwork_fd,
+                            size=size),
+                        album_art_id or remote_id, file_suffix,
+                        cost_class=self.connections[
+                            database_id].get_cost_class(
+                                file_suffix, artwork=True)))
+                count += 1
 
             # Items
-            if item_id not in self.item_cache.items:
-                logger.debug("Item with key '%d' not in cache.", item_id)
-                cache_item = self.item_cache.get(item_id)
+            item_key = self.get_item_cache_key(
+                item_id, cached_items[item_id])
+
+            if item_key not in self.item_cache.items:
+                logger.debug("Item with key '%s' not in cache.", item_key)
+                self.warmer.enqueue(
+                    "item-%s" % item_key, partial(
+                        self.cache_file, self.item_cache, item_key,
+                        self.connections[database_id].get_item_fd,
+                        remote_id, file_suffix,
+                        on_cached=self.on_item_cached(item_key),
+                        file_size=self.get_resumable_size(
+                            item_key, cached_items[item_id]),
+                        cost_class=self.connections[
+                            database_id].get_cost_class(file_suffix)))
+                count += 1
+
+        logger.info(
+            "Queued %d files of %d permanent items for caching.", count,
+            len(cached_items))
+
+        if self.head_cache and self.head_containers:
+            self.cache_heads()
+
+    def cache_heads(self):
+        """
+        Queue the heads of all items of the selected containers, unless the
+        item or its head is in the caches already.
+        """
+
+        head_items = self.get_head_items()
+        count = 0
+
+        for item_id, head_item in head_items.iteritems():
+            item_key = self.get_item_cache_key(item_id, head_item)
 
-                if not cache_item.ready.is_set():
-                    remote_fd = self.connections[database_id].get_item_fd(
-                        remote_id, file_suffix)
-                    self.item_cache.download(item_id, cache_item, remote_fd)
+            # Heads of transcoded items cannot be resumed.
+            if not isinstance(item_key, (int, long)) or \
+                    item_key in self.item_cache.items or \
+                    item_key in self.head_cache.items:
+                continue
 
-                    # Exhaust iterator so it downloads the item.
-                    exhaust(cache_item.iterator())
+            head_size = self.get_head_size(
+                head_item["file_size"], head_item["duration"])
 
-        # Cleanup left-overs of all items that are loaded.
-        self.expire()
+            if not head_size:
+                continue
 
-        logger.info("Caching permanent items finished.")
+            self.warmer.enqueue(
+                "head-%s" % item_key, partial(
+                    self.cache_head, item_key,
+                    self.connections[head_item["database_id"]].get_item_fd,
+                    head_item["remote_id"], head_item["file_suffix"],
+                    head_size))
+            count += 1
+
+        logger.info(
+            "Queued %d heads of %d items for caching.", count,
+            len(head_items))
+
+    def cache_file(self, file_cache, cache_key, get_fd, remote_id,
+                   file_suffix, limit=None, on_cached=None, file_size=None,
+                   priority=downloads.BACKGROUND, cost_class=None):
+        """
+        Download a file into a cache, unless it is in the cache already.
+
+        :param FileCache file_cache: Cache to download the file into.
+        :param callable get_fd: Method of the connection that returns the
+                                remote file descriptor.
+        :param callable limit: Method that applies a bandwidth cap to the
+                               remote file descriptor, if any.
+        :param callable on_cached: Method that is invoked with the file size
+                                   once the file is downloaded.
+        :param int file_size: Size of the remote file, if it supports byte
+                              ranges. Used to resume an interrupted download.
+        :param int priority: Priority class of the download.
+        :param str cost_class: Class of the download, to measure the cost of
+                               downloading it again.
+        """
+
+        state = {"priority": priority, "remote_fds": []}
+
+        def remote_fd_factory(byte_range=None):
+            if byte_range:
+                remote_fd = get_fd(
+                    remote_id, file_suffix, byte_range=byte_range,
+                    priority=state["priority"])
+            else:
+                remote_fd = get_fd(
+                    remote_id, file_suffix, priority=state["priority"])
+
+            state["remote_fds"].append(remote_fd)
+
+            if limit:
+                return limit(remote_fd)
+
+            return remote_fd
+
+        def prioritize(new_priority):
+            """
+            Raise the priority of the download, and of the remote files that
+            are open.
+            """
+
+            state["priority"] = min(state["priority"], new_priority)
+
+            for remote_fd in state["remote_fds"]:
+                if hasattr(remote_fd, "prioritize"):
+                    remote_fd.prioritize(new_priority)
+
+        cache_item = file_cache.get(cache_key)
+
+        if cache_item.downloading:
+            # Another request is downloading the file already. Tail it until
+            # it is done.
+            if cache_item.prioritize:
+                cache_item.prioritize(priority)
+
+            exhaust(cache_item.iterator())
+        elif not cache_item.ready.is_set():
+            # Requests that tail the download can raise its priority.
+            cache_item.prioritize = prioritize
+
+            try:
+                try:
+                    if file_size and file_cache.has_partial(cache_key):
+                        file_cache.download_ranged(
+                            cache_key, cache_item, remote_fd_factory,
+                            file_size, cost_class=cost_class)
+                    else:
+                        file_cache.download(
+                            cache_key, cache_item, remote_fd_factory(),
+                            on_cached=on_cached, cost_class=cost_class)
+                except BaseException:
+                    # Opening the remote file failed or was interrupted.
+                    # Forget the item, or later requests wait for it forever.
+                    if cache_item.iterator is None:
+                        file_cache.discard(cache_key)
+
+                    raise
+
+                # Exhaust iterator so it downloads the file.
+                exhaust(cache_item.iterator())
+            finally:
+                cache_item.prioritize = None
 
     def expire(self):
         """
@@ -515,3 +2193,22 @@ class CacheManager(object):
 
         self.item_cache.clean(force)
         self.artwork_cache.clean(force)
+
+        if self.head_cache:
+            self.head_cache.clean(force)
+
+        self.compact(force)
+
+    def compact(self, force=False):
+        """
+        Compact the manifests of the caches, once enough changes have been
+        appended to them. This also records the recent access order.
+
+        :param bool force: If true, always compact the manifests.
+        """
+
+        self.item_cache.compact_manifest(force)
+        self.artwork_cache.compact_manifest(force)
+
+        if self.head_cache:
+            self.head_cache.compact_manifest(force)
@@ -2,13 +2,49 @@ from daapserver import collection
 
 from subdaap import utils
 
+# Table that backs a collection, given the name of its child class.
+TABLES = {
+    "Database": "databases",
+    "Item": "items",
+    "Container": "containers",
+    "ContainerItem": "container_items"
+}
+
 
 class LazyMutableCollection(collection.LazyMutableCollection):
 
-    __slots__ = collection.LazyMutableCollection.__slots__ + ("child_class", )
+    __slots__ = collection.LazyMutableCollection.__slots__ + (
+        "child_class", "count_revision", "count_value", "count_max_id")
+
+    def __init__(self, *args, **kwargs):
+        super(LazyMutableCollection, self).__init__(*args, **kwargs)
+
+        self.count_revision = None
+        self.count_value = None
+        self.count_max_id = None
 
     def count(self):
         """
+        Return the number of items in this collection, without loading them.
+
+        The result is memoized per revision. Inserts made via `update_ids` are
+        applied incrementally, so the aggregate query only runs again after
+        IDs have been removed.
+        """
+
+        if self.count_revision != self.store.revision:
+            with self.parent.db.get_cursor() as cursor:
+                self.count_value = self.query_count(cursor)
+                self.count_max_id = self.query_max_id(cursor)
+
+            self.count_revision = self.store.revision
+
+        return self.count_value
+
+    def query_count(self, cursor, in_clause=""):
+        """
+        Execute the count query. An additional `in_clause` can be specified to
+        limit the rows that are counted.
         """
 
         # Prepare query depending on `self.child_class`. Use name to prevent
@@ -23,8 +59,9 @@ class LazyMutableCollection(collection.LazyMutableCollection):
                     `databases`
                 WHERE
                     `databases`.`exclude` = 0
+                    %s
                 LIMIT 1
-                """,
+                """ % in_clause,
         elif child_class_name == "Item":
             query = """
                 SELECT
@@ -44,8 +81,9 @@ class LazyMutableCollection(collection.LazyMutableCollection):
                     COALESCE(`artists`.`exclude`, 0) = 0 AND
                     COALESCE(`album_artists`.`exclude`, 0) = 0 AND
                     COALESCE(`albums`.`exclude`, 0) = 0
+                    %s
                 LIMIT 1
-                """, self.parent.id
+                """ % in_clause, self.parent.id
         elif child_class_name == "Container":
             query = """
                 SELECT
@@ -55,8 +93,9 @@ class LazyMutableCollection(collection.LazyMutableCollection):
                 WHERE
                     `containers`.`database_id` = ? AND
                     `containers`.`exclude` = 0
+                    %s
                 LIMIT 1
-                """, self.parent.id
+                """ % in_clause, self.parent.id
         elif child_class_name == "ContainerItem":
             query = """
                 SELECT
@@ -79,12 +118,81 @@ class LazyMutableCollection(collection.LazyMutableCollection):
                     COALESCE(`artists`.`exclude`, 0) = 0 AND
                     COALESCE(`album_artists`.`exclude`, 0) = 0 AND
                     COALESCE(`albums`.`exclude`, 0) = 0
+                    %s
                 LIMIT 1
-                """, self.parent.id, self.parent.database_id
+                """ % in_clause, self.parent.database_id, self.parent.id
 
         # Execute query.
-        with self.parent.db.get_cursor() as cursor:
-            return cursor.query_value(*query)
+        return cursor.query_value(*query)
+
+    def query_max_id(self, cursor):
+        """
+        Return the highest row ID of the table that backs this collection.
+        SQLite assigns new rows an ID that is higher than any existing ID, so
+        this is used to distinguish inserted rows from updated rows.
+        """
+
+        table = TABLES[self.child_class.__name__]
+
+        return cursor.query_value(
+            "SELECT MAX(`%s`.`id`) FROM `%s`" % (table, table)) or 0
+
+    def update_ids(self, item_ids):
+        """
+        (Re-)load the given IDs. If this collection is not ready, a memoized
+        count is kept up-to-date by counting the IDs that have been inserted
+        since the count was taken.
+
+        The synchronizer invokes `remove_ids` before this method, after the
+        database has been updated. Therefore, the highest row ID is only
+        refreshed here.
+        """
+
+        if not self.ready and self.count_revision is not None:
+            item_ids = list(item_ids)
+            table = TABLES[self.child_class.__name__]
+
+            with self.parent.db.get_cursor() as cursor:
+                if item_ids:
+                    in_clause = " AND `%s`.`id` IN (%s) AND `%s`.`id` > %d" % (
+                        table, utils.in_list(item_ids), table,
+                        self.count_max_id)
+
+                    self.count_value += self.query_count(cursor, in_clause)
+
+                # Rows may have been removed, so take the new highest ID.
+                self.count_max_id = self.query_max_id(cursor)
+
+        super(LazyMutableCollection, self).update_ids(item_ids)
+
+    def remove_ids(self, item_ids):
+        """
+        Remove the given IDs. If this collection is not ready and IDs are
+        removed, a memoized count is forgotten, because the removed IDs are not
+        necessarily part of this collection (e.g. rows that are excluded by its
+        query).
+        """
+
+        item_ids = list(item_ids)
+
+        if item_ids and not self.ready:
+            self.count_revision = None
+
+        super(LazyMutableCollection, self).remove_ids(item_ids)
+
+    def commit(self, revision):
+        """
+        Commit the collection. A memoized count that is still valid is carried
+        over to the new revision, since inserts have been applied
+        incrementally.
+        """
+
+        memoized = self.count_revision == self.store.revision
+
+        super(LazyMutableCollection, self).commit(revision)
+
+        if memoized:
+            self.count_revision = self.store.revision
 
     def load(self, item_ids=None):
         """
@@ -131,6 +239,7 @@ class LazyMutableCollection(collection.LazyMutableCollection):
                     `items`.`database_id`,
                     `items`.`persistent_id`,
                     `items`.`remote_id`,
+                    `items`.`album_id`,
                     `items`.`name`,
                     `items`.`track`,
                     `items`.`year`,
@@ -144,7 +253,8 @@ class LazyMutableCollection(collection.LazyMutableCollection):
                     `artists`.`name` as `artist`,
                     `album_artists`.`name` as `album_artist`,
                     `albums`.`name` as `album`,
-                    `albums`.`art` as `album_art`
+                    `albums`.`art` as `album_art`,
+                    `albums`.`art_name` as `album_art_id`
                 FROM
                     `items`
                 LEFT OUTER JOIN
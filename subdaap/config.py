@@ -25,6 +25,7 @@ synchronization interval = integer(min=1, default=1440)
 
 transcode = option("no", "unsupported", "all", default="no")
 transcode unsupported = lowercase_string_list(default=list("flac"))
+transcode bitrate = integer(min=0, max=320, default=0)
 
 [Daap]
 interface = string(default="0.0.0.0")
@@ -44,15 +45,35 @@ artwork cache = boolean(default=True)
 artwork cache dir = string(default="./artwork")
 artwork cache size = integer(min=0, default=0)
 artwork cache prune threshold = float(min=0, max=1.0, default=0.1)
+artwork cache eviction = option("lru", "slru", "gds", default="lru")
+artwork cache memory size = integer(min=0, default=16)
+artwork sizes = int_list(default=list(128, 256, 512))
 
 item cache = boolean(default=True)
 item cache dir = string(default="./items")
 item cache size = integer(min=0, default=0)
 item cache prune threshold = float(min=0, max=1.0, default=0.25)
+item cache eviction = option("lru", "slru", "gds", default="slru")
+item max chunk size = integer(min=0, default=256)
+item cache memory size = integer(min=0, default=0)
+item head seconds = integer(min=0, default=0)
+item head cache dir = string(default="./heads")
+item head cache size = integer(min=0, default=1024)
+item head containers = string_list(default=list())
+item popular cache size = integer(min=0, default=0)
+item popular cache interval = integer(min=1, default=60)
+item prefetch = integer(min=0, default=2)
+item prefetch budget = integer(min=0, default=64)
 item cache prune interval = integer(min=1, default=5)
 
+download bandwidth = integer(min=0, default=0)
+
+permanent cache concurrency = integer(min=1, default=2)
+permanent cache bandwidth = integer(min=0, default=0)
+
 [Advanced]
 open files limit = integer(min=-1, default=-1)
+cache open files = integer(min=0, default=128)
 """ % CONFIG_VERSION
 
 
@@ -2,6 +2,7 @@ import collections
 
 from subdaap.subsonic import SubsonicClient
 from subdaap.synchronizer import Synchronizer
+from subdaap import downloads
 
 import logging
 
@@ -15,10 +16,12 @@ class Connection(object):
     required to connect and synchronize.
     """
     transcode_format = collections.defaultdict(lambda: 'audio/mpeg')
+    transcode_suffix = "mp3"
 
     def __init__(self, state, db, index, name, url, username, password,
                  synchronization, synchronization_interval, transcode,
-                 transcode_unsupported):
+                 transcode_unsupported, transcode_bitrate=0,
+                 download_scheduler=None):
         """
         Construct a new connection.
 
@@ -35,6 +38,11 @@ class Connection(object):
         :param str transcode: Either 'all', 'unsupported' or 'no'.
         :param list transcode_unsupported: List of file extensions that are not
                                            supported, thus will be transcoded.
+        :param int transcode_bitrate: Maximum bitrate (in kbps) of transcoded
+                                      items, or 0 for the server default.
+        :param DownloadScheduler download_scheduler: Scheduler that
+                                                     coordinates downloads of
+                                                     all connections.
         """
 
         self.db = db
@@ -52,6 +60,9 @@ class Connection(object):
 
         self.transcode = transcode
         self.transcode_unsupported = transcode_unsupported
+        self.transcode_bitrate = transcode_bitrate
+
+        self.download_scheduler = download_scheduler
 
         self.setup_subsonic()
         self.setup_synchronizer()
@@ -85,24 +96,74 @@ class Connection(object):
             self.transcode == "unsupported" and
             file_suffix.lower() in self.transcode_unsupported)
 
-    def get_item_fd(self, remote_id, file_suffix):
+    def get_item_cache_key(self, item_id, file_suffix):
+        """
+        Get the item cache key of an item. Transcoded items are cached
+        separately for each output format and bitrate, so they never collide
+        with the original file when the transcode settings change.
+        """
+
+        if self.needs_transcoding(file_suffix):
+            return "%d-%s-%d" % (
+                item_id, self.transcode_suffix, self.transcode_bitrate)
+
+        return item_id
+
+    def get_cost_class(self, file_suffix, artwork=False):
+        """
+        Get the class of a download from this connection, to measure the cost
+        of downloading it again. Transcodes are measured per output format and
+        bitrate, because transcoding is often slower than downloading.
+        """
+
+        if artwork:
+            return "%d-artwork" % self.index
+
+        if self.needs_transcoding(file_suffix):
+            return "%d-%s-%d" % (
+                self.index, self.transcode_suffix, self.transcode_bitrate)
+
+        return "%d-%s" % (self.index, file_suffix)
+
+    def get_item_fd(self, remote_id, file_suffix, byte_range=None,
+                    priority=downloads.INTERACTIVE):
         """
         Get a file descriptor of remote connection of an item, based on
         transcoding settings.
+
+        A byte range (begin, end) can only be requested if the item is not
+        transcoded.
         """
 
         if self.needs_transcoding(file_suffix):
             logger.debug(
                 "Transcoding item '%d' with file suffix '%s'.",
                 remote_id, file_suffix)
-            return self.subsonic.stream(
-                remote_id, tformat=self.transcode_format)
+            remote_fd = self.subsonic.stream(
+                remote_id, maxBitRate=self.transcode_bitrate,
+                tformat=self.transcode_suffix)
         else:
-            return self.subsonic.download(remote_id)
+            remote_fd = self.subsonic.download(
+                remote_id, byte_range=byte_range)
+
+        return self.schedule(remote_fd, priority)
 
-    def get_artwork_fd(self, remote_id, file_suffix):
+    def get_artwork_fd(self, remote_id, file_suffix, size=None,
+                       priority=downloads.ARTWORK):
         """
-        Get a file descriptor of a remote connection of an artwork item.
+        Get a file descriptor of a remote connection of an artwork item. If a
+        size is given, the server scales the artwork down.
         """
 
-        return self.subsonic.getCoverArt(remote_id)
+        return self.schedule(
+            self.subsonic.getCoverArt(remote_id, size), priority)
+
+    def schedule(self, remote_fd, priority):
+        """
+        Register a download with the download scheduler, if there is one.
+        """
+
+        if self.download_scheduler is None:
+            return remote_fd
+
+        return self.download_scheduler.open(remote_fd, priority)
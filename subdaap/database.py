@@ -73,6 +73,8 @@ class Database(object):
             # Add extra SQL to drop all tables if desired
             if drop_all:
                 extra = """
+                    DROP TABLE IF EXISTS `plays`;
+                    DROP TABLE IF EXISTS `transcodes`;
                     DROP TABLE IF EXISTS `container_items`;
                     DROP TABLE IF EXISTS `containers`;
                     DROP TABLE IF EXISTS `items`;
@@ -184,6 +186,15 @@ class Database(object):
                             FOREIGN KEY (`container_id`)
                                 REFERENCES `containers` (`id`)
                     );
+                    CREATE TABLE IF NOT EXISTS `transcodes` (
+                        `cache_key` varchar(255) PRIMARY KEY,
+                        `file_size` int(11) NOT NULL
+                    );
+                    CREATE TABLE IF NOT EXISTS `plays` (
+                        `item_id` INTEGER PRIMARY KEY,
+                        `play_count` int(11) NOT NULL,
+                        `last_played` int(11) NOT NULL
+                    );
                     """)
 
 
@@ -0,0 +1,188 @@
+from subdaap.warmer import RateLimiter
+
+import collections
+import logging
+import gevent
+import gevent.event
+
+# Logger instance
+logger = logging.getLogger(__name__)
+
+# Priority classes of downloads, from high to low.
+INTERACTIVE = 0
+ARTWORK = 1
+PREFETCH = 2
+BACKGROUND = 3
+
+# Share of the bandwidth of each priority class, relative to the other classes
+# that are downloading.
+WEIGHTS = {
+    INTERACTIVE: 8,
+    ARTWORK: 4,
+    PREFETCH: 2,
+    BACKGROUND: 1
+}
+
+# Time in seconds a paused download waits, before it reads another chunk to
+# keep the remote connection alive.
+TIMEOUT_PAUSED = 10
+
+
+class ScheduledFile(object):
+    """
+    Wrapper for a remote file descriptor, that lets the download scheduler
+    decide when data is read.
+    """
+
+    def __init__(self, fd, scheduler, priority):
+        self.fd = fd
+        self.scheduler = scheduler
+        self.priority = priority
+        self.closed = False
+        self.woken = gevent.event.Event()
+
+    def read(self, size=-1):
+        self.scheduler.wait(self.priority, self.woken)
+        self.woken.clear()
+
+        data = ""
+
+        try:
+            data = self.fd.read(size)
+        finally:
+            if not data:
+                self.finish()
+
+        self.scheduler.consume(self.priority, len(data))
+
+        return data
+
+    def prioritize(self, priority):
+        """
+        Raise the priority class of the download, e.g. when an interactive
+        client starts tailing a download that runs in the background. A paused
+        download is woken up.
+
+        :param int priority: New priority class. Lower priorities are ignored.
+        """
+
+        if self.closed or priority >= self.priority:
+            return
+
+        self.scheduler.unregister(self.priority)
+        self.priority = priority
+        self.scheduler.register(priority)
+
+        self.woken.set()
+
+    def close(self):
+        self.finish()
+        self.fd.close()
+
+    def finish(self):
+        if not self.closed:
+            self.closed = True
+            self.scheduler.unregister(self.priority)
+
+
+class DownloadScheduler(object):
+    """
+    Coordinate all downloads from the remote servers. Downloads have a
+    priority class. When a bandwidth is configured, it is shared between the
+    classes that are downloading according to their weights. Otherwise,
+    prefetch and background downloads are paused while an interactive stream
+    is downloading.
+    """
+
+    def __init__(self, bandwidth=0):
+        """
+        Construct a new download scheduler.
+
+        :param int bandwidth: Available download bandwidth (in KB/s) to share
+                              between classes, or 0 if unknown.
+        """
+
+        self.bandwidth = bandwidth * 1024
+
+        self.active = collections.defaultdict(int)
+        self.limiters = {}
+        self.resumed = gevent.event.Event()
+        self.resumed.set()
+
+        if self.bandwidth:
+            for priority in WEIGHTS:
+                self.limiters[priority] = RateLimiter(self.bandwidth)
+
+    def open(self, remote_fd, priority):
+        """
+        Register a new download of a given priority class.
+
+        :param file remote_fd: Remote file descriptor.
+        :param int priority: Priority class of the download.
+        :return: File-like object to read the download from.
+        """
+
+        self.register(priority)
+
+        return ScheduledFile(remote_fd, self, priority)
+
+    def register(self, priority):
+        """
+        Register a download of a given priority class.
+
+        :param int priority: Priority class of the download.
+        """
+
+        self.active[priority] += 1
+
+        if priority == INTERACTIVE:
+            self.resumed.clear()
+
+    def unregister(self, priority):
+        """
+        Unregister a finished download.
+
+        :param int priority: Priority class of the download.
+        """
+
+        self.active[priority] -= 1
+
+        if not self.active[INTERACTIVE]:
+            self.resumed.set()
+
+    def wait(self, priority, woken=None):
+        """
+        Block lower priority classes while an interactive stream is
+        downloading, if there is no bandwidth to share.
+
+        :param int priority: Priority class of the download.
+        :param Event woken: Event that ends the wait early, e.g. when the
+                            priority of the download is raised.
+        """
+
+        if not self.bandwidth and priority >= PREFETCH:
+            if woken is None:
+                self.resumed.wait(timeout=TIMEOUT_PAUSED)
+            else:
+                gevent.wait(
+                    [self.resumed, woken], timeout=TIMEOUT_PAUSED, count=1)
+
+    def consume(self, priority, amount):
+        """
+        Account for downloaded bytes, and throttle the download to the share
+        of its priority class.
+
+        :param int priority: Priority class of the download.
+        :param int amount: Number of bytes downloaded.
+        """
+
+        if not self.bandwidth or not amount:
+            return
+
+        total = sum(
+            weight for other, weight in WEIGHTS.iteritems()
+            if self.active[other] or other == priority)
+
+        limiter = self.limiters[priority]
+        limiter.rate = self.bandwidth * WEIGHTS[priority] / total
+        limiter.consume(amount)
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+
+import logging
+
+# Logger instance
+logger = logging.getLogger(__name__)
+
+
+class HandlePool(object):
+    """
+    Bounded pool of the file handles that are held open by loaded cache items.
+    The pool is shared by all caches. When the number of open handles exceeds
+    the ceiling, the least recently used items that are not in use are closed.
+    They are reopened on demand.
+    """
+
+    def __init__(self, max_handles=0):
+        """
+        Construct a new handle pool.
+
+        :param int max_handles: Maximum number of open handles, or 0 for
+                                unlimited.
+        """
+
+        self.max_handles = max_handles
+
+        self.handles = OrderedDict()
+        self.count = 0
+
+    def add(self, file_cache, cache_key, count=1):
+        """
+        Register the handles of an item that has been loaded, as most recently
+        used. Closes other items if the ceiling is exceeded.
+
+        :param FileCache file_cache: Cache the item belongs to.
+        :param str cache_key:
+        :param int count: Number of handles held by the item.
+        """
+
+        self.remove(file_cache, cache_key)
+
+        self.handles[file_cache, cache_key] = count
+        self.count += count
+
+        self.trim()
+
+    def touch(self, file_cache, cache_key):
+        """
+        Mark the handles of an item as recently used, if it has any.
+
+        :param FileCache file_cache: Cache the item belongs to.
+        :param str cache_key:
+        """
+
+        count = self.handles.pop((file_cache, cache_key), None)
+
+        if count is not None:
+            self.handles[file_cache, cache_key] = count
+
+    def remove(self, file_cache, cache_key):
+        """
+        Unregister the handles of an item that has been unloaded.
+
+        :param FileCache file_cache: Cache the item belongs to.
+        :param str cache_key:
+        """
+
+        self.count -= self.handles.pop((file_cache, cache_key), 0)
+
+    def trim(self):
+        """
+        Close the least recently used items until the number of open handles
+        is below the ceiling. Items that are in use are skipped.
+        """
+
+        if not self.max_handles or self.count <= self.max_handles:
+            return
+
+        closed = 0
+
+        for file_cache, cache_key in self.handles.keys():
+            if self.count <= self.max_handles:
+                break
+
+            if file_cache.close(cache_key):
+                closed += 1
+
+        logger.debug(
+            "Closed %d items, %d of %d handles open.", closed, self.count,
+            self.max_handles)
@@ -44,7 +44,8 @@ class Item(models.Item):
     Database-aware Item object.
     """
 
-    __slots__ = models.Item.__slots__ + ("remote_id", )
+    __slots__ = models.Item.__slots__ + (
+        "remote_id", "album_id", "album_art_id")
 
     def __init__(self, db, *args, **kwargs):
         super(Item, self).__init__(*args, **kwargs)
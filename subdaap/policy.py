@@ -0,0 +1,410 @@
+from collections import OrderedDict
+
+import itertools
+import heapq
+
+# Estimated time (in seconds) to download one byte, if nothing has been
+# measured yet (1 MB/s).
+DEFAULT_RATE = 1.0 / 1048576
+
+# Estimated time (in seconds) to set up a download, in addition to the time
+# to download its bytes.
+REQUEST_OVERHEAD = 0.5
+
+# Weight of a new measurement in the moving average of download rates.
+RATE_SMOOTHING = 0.2
+
+
+class LRUPolicy(object):
+    """
+    Least recently used eviction policy. The item that has not been accessed
+    for the longest time is evicted first.
+    """
+
+    def __init__(self):
+        self.keys = OrderedDict()
+
+    def add(self, cache_key):
+        """
+        Add a new key, as most recently used.
+
+        :param str cache_key:
+        """
+
+        self.keys.pop(cache_key, None)
+        self.keys[cache_key] = True
+
+    def access(self, cache_key):
+        """
+        Mark a key as accessed.
+
+        :param str cache_key:
+        """
+
+        self.add(cache_key)
+
+    def remove(self, cache_key):
+        """
+        Remove a key, if it is known.
+
+        :param str cache_key:
+        """
+
+        self.keys.pop(cache_key, None)
+
+    def evict(self, cache_key):
+        """
+        Remove a key that has been evicted.
+
+        :param str cache_key:
+        """
+
+        self.remove(cache_key)
+
+    def weigh(self, cache_key, size, cost):
+        """
+        Record the size of a key and the cost to fetch it again. Not used by
+        this policy.
+        """
+
+        pass
+
+    def candidates(self):
+        """
+        Iterate over the keys in the order they should be evicted. The policy
+        should not be changed during iteration.
+        """
+
+        return self.keys.iterkeys()
+
+
+class SLRUPolicy(object):
+    """
+    Segmented LRU eviction policy. New keys enter a probationary segment, and
+    are promoted to a protected segment when accessed again. Keys that are
+    accessed once, such as during a scan over many items, are evicted before
+    the protected keys that are accessed repeatedly.
+    """
+
+    def __init__(self, protected_ratio=0.8):
+        """
+        Construct a new segmented LRU policy.
+
+        :param float protected_ratio: Maximum fraction of keys that can be in
+                                      the protected segment.
+        """
+
+        self.protected_ratio = protected_ratio
+
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+
+    def add(self, cache_key):
+        """
+        Add a new key to the probationary segment.
+
+        :param str cache_key:
+        """
+
+        self.remove(cache_key)
+        self.probation[cache_key] = True
+
+    def access(self, cache_key):
+        """
+        Mark a key as accessed. A key that is accessed again is promoted to
+        the protected segment. If the protected segment is full, its least
+        recently used key is demoted to the probationary segment.
+
+        :param str cache_key:
+        """
+
+        if cache_key in self.protected:
+            del self.protected[cache_key]
+            self.protected[cache_key] = True
+            return
+
+        if self.probation.pop(cache_key, None) is None:
+            self.probation[cache_key] = True
+            return
+
+        self.protected[cache_key] = True
+
+        limit = int(self.protected_ratio * (
+            len(self.probation) + len(self.protected)))
+
+        while len(self.protected) > max(limit, 1):
+            demoted_key, _ = self.protected.popitem(last=False)
+            self.probation[demoted_key] = True
+
+    def remove(self, cache_key):
+        """
+        Remove a key, if it is known.
+
+        :param str cache_key:
+        """
+
+        if self.probation.pop(cache_key, None) is None:
+            self.protected.pop(cache_key, None)
+
+    def evict(self, cache_key):
+        """
+        Remove a key that has been evicted.
+
+        :param str cache_key:
+        """
+
+        self.remove(cache_key)
+
+    def weigh(self, cache_key, size, cost):
+        """
+        Record the size of a key and the cost to fetch it again. Not used by
+        this policy.
+        """
+
+        pass
+
+    def candidates(self):
+        """
+        Iterate over the keys in the order they should be evicted. The policy
+        should not be changed during iteration.
+        """
+
+        return itertools.chain(
+            self.probation.iterkeys(), self.protected.iterkeys())
+
+
+class GreedyDualSizePolicy(object):
+    """
+    GreedyDual-Size eviction policy, with frequency. Each key has a priority
+    of L + frequency * cost / size, where cost is the time to fetch it again,
+    frequency is the number of accesses since it was added, and L is the
+    priority of the last evicted key. The key with the lowest priority is
+    evicted first, so keys that are cheap to fetch again per byte, or that
+    are rarely accessed, go first. L rises with every eviction, so keys that
+    have not been accessed for a long time are evicted eventually, no matter
+    how expensive they are.
+
+    The keys are kept in a heap, ordered by priority. A key that changes
+    priority gets a new heap entry. The old entry is skipped when it comes
+    up, and the heap is rebuilt if it holds too many old entries.
+    """
+
+    def __init__(self):
+        self.inflation = 0.0
+
+        self.heap = []
+        self.entries = {}
+        self.weights = {}
+        self.frequencies = {}
+        self.counter = itertools.count()
+
+    def add(self, cache_key):
+        """
+        Add a new key, with the priority of a recently accessed key.
+
+        :param str cache_key:
+        """
+
+        self.frequencies[cache_key] = 1
+        self.prioritize(cache_key)
+
+    def access(self, cache_key):
+        """
+        Mark a key as accessed, which restores and raises its priority.
+
+        :param str cache_key:
+        """
+
+        self.frequencies[cache_key] = self.frequencies.get(cache_key, 0) + 1
+        self.prioritize(cache_key)
+
+    def prioritize(self, cache_key):
+        """
+        Set the priority of a key, relative to the current value of L.
+
+        :param str cache_key:
+        """
+
+        self.push(cache_key, self.inflation + (
+            self.frequencies[cache_key] * self.weights.get(cache_key, 0.0)))
+
+    def push(self, cache_key, priority):
+        """
+        Add a heap entry for a key, which replaces its old entry.
+
+        :param str cache_key:
+        :param float priority:
+        """
+
+        # The counter breaks ties, so keys are never compared.
+        entry = [priority, next(self.counter), cache_key]
+
+        self.entries[cache_key] = entry
+        heapq.heappush(self.heap, entry)
+
+        if len(self.heap) > 2 * len(self.entries) + 1024:
+            self.heap = self.entries.values()
+            heapq.heapify(self.heap)
+
+    def remove(self, cache_key):
+        """
+        Remove a key, if it is known.
+
+        :param str cache_key:
+        """
+
+        self.entries.pop(cache_key, None)
+        self.weights.pop(cache_key, None)
+        self.frequencies.pop(cache_key, None)
+
+    def evict(self, cache_key):
+        """
+        Remove a key that has been evicted. Its priority becomes the new base
+        priority of keys that are accessed.
+
+        :param str cache_key:
+        """
+
+        entry = self.entries.get(cache_key)
+
+        if entry is not None:
+            self.inflation = max(self.inflation, entry[0])
+
+        self.remove(cache_key)
+
+    def weigh(self, cache_key, size, cost):
+        """
+        Record the size of a key and the cost to fetch it again.
+
+        :param str cache_key:
+        :param int size: Size in bytes.
+        :param float cost: Time in seconds to fetch it again.
+        """
+
+        entry = self.entries.get(cache_key)
+
+        if entry is None:
+            return
+
+        old_weight = self.weights.get(cache_key, 0.0)
+        weight = self.weights[cache_key] = cost / max(size, 1)
+
+        if weight == old_weight:
+            return
+
+        self.push(cache_key, entry[0] + (
+            self.frequencies[cache_key] * (weight - old_weight)))
+
+    def candidates(self):
+        """
+        Iterate over the keys in the order they should be evicted. The policy
+        should not be changed during iteration.
+
+        Entries are popped from the heap while iterating, and pushed back
+        when the iteration ends, so stopping early is cheap.
+        """
+
+        popped = []
+
+        try:
+            while self.heap:
+                entry = heapq.heappop(self.heap)
+                cache_key = entry[2]
+
+                # Skip (and drop) old entries.
+                if self.entries.get(cache_key) is not entry:
+                    continue
+
+                popped.append(entry)
+                yield cache_key
+        finally:
+            for entry in popped:
+                heapq.heappush(self.heap, entry)
+
+
+class RefetchCosts(object):
+    """
+    Estimate the time to fetch an item again. Download rates are measured per
+    class of download, e.g. per connection and format, so items from a slow
+    connection or that need transcoding are estimated to be more expensive.
+    """
+
+    def __init__(self):
+        self.rates = {}
+        self.classes = {}
+
+    def measure(self, cache_key, cost_class, elapsed, size):
+        """
+        Record a completed download.
+
+        :param str cache_key: Key of the downloaded item.
+        :param str cost_class: Class of the download, or None if unknown.
+        :param float elapsed: Time the download took, in seconds.
+        :param int size: Number of bytes downloaded.
+        """
+
+        if cost_class is None:
+            return
+
+        self.classes[cache_key] = cost_class
+
+        if size <= 0:
+            return
+
+        rate = elapsed / size
+        old_rate = self.rates.get(cost_class)
+
+        if old_rate is None:
+            self.rates[cost_class] = rate
+        else:
+            self.rates[cost_class] = \
+                old_rate * (1 - RATE_SMOOTHING) + rate * RATE_SMOOTHING
+
+    def estimate(self, cache_key, size):
+        """
+        Estimate the time (in seconds) to fetch an item again. Items of which
+        the class is not known are estimated with the average rate.
+
+        :param str cache_key: Key of the item.
+        :param int size: Size of the item, in bytes.
+        """
+
+        rate = self.rates.get(self.classes.get(cache_key))
+
+        if rate is None:
+            if self.rates:
+                rate = sum(self.rates.itervalues()) / len(self.rates)
+            else:
+                rate = DEFAULT_RATE
+
+        return REQUEST_OVERHEAD + size * rate
+
+    def forget(self, cache_key):
+        """
+        Forget the class of an item that is not cached anymore.
+
+        :param str cache_key:
+        """
+
+        self.classes.pop(cache_key, None)
+
+
+# Available policies, by configuration name.
+POLICIES = {
+    "lru": LRUPolicy,
+    "slru": SLRUPolicy,
+    "gds": GreedyDualSizePolicy
+}
+
+
+def create_policy(name):
+    """
+    Create a new eviction policy instance, given its name.
+
+    :param str name: Name of the policy, see `POLICIES`.
+    """
+
+    try:
+        return POLICIES[name]()
+    except KeyError:
+        raise ValueError("Unknown eviction policy: %s" % name)
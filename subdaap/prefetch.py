@@ -0,0 +1,183 @@
+from subdaap import downloads
+
+import logging
+import gevent
+
+# Logger instance
+logger = logging.getLogger(__name__)
+
+# Time in seconds to wait before prefetching, so the item that just started
+# streaming gets the bandwidth first.
+PREFETCH_DELAY = 5
+
+
+class Prefetcher(object):
+    """
+    Download the items that are likely to be played next into the item cache,
+    so playback continues without gaps on slow connections. The next items
+    are determined by the order of the container the client browsed last, or
+    by the track number within the album.
+    """
+
+    def __init__(self, db, cache_manager, connections, count, budget):
+        """
+        Construct a new prefetcher.
+
+        :param int count: Number of items to prefetch, or 0 to disable.
+        :param int budget: Maximum number of bytes (in MB) to prefetch per
+                           stream start.
+        """
+
+        self.db = db
+        self.cache_manager = cache_manager
+        self.connections = connections
+        self.count = count
+        self.budget = budget * 1024 * 1024
+
+        self.greenlets = {}
+
+    def schedule(self, session, item, container_id=None):
+        """
+        Schedule the items following an item for prefetching. Prefetching of
+        a previous item by the same session is cancelled, because the user
+        skipped away from it.
+
+        :param Session session: Client session that started streaming.
+        :param Item item: Item that started streaming.
+        :param int container_id: ID of the container that was browsed last, or
+                                 None if it is not known.
+        """
+
+        if not self.count:
+            return
+
+        self.cancel(session)
+
+        self.greenlets[session] = gevent.spawn_later(
+            PREFETCH_DELAY, self.prefetch, session, item, container_id)
+
+    def cancel(self, session):
+        """
+        Cancel prefetching for a session. The greenlet is not killed, because
+        that could leave an item behind that is half set up. Instead, it stops
+        before the next item.
+
+        :param Session session: Client session.
+        """
+
+        self.greenlets.pop(session, None)
+
+    def is_cancelled(self, session):
+        """
+        Return True if prefetching by the current greenlet has been cancelled.
+        """
+
+        return self.greenlets.get(session) is not gevent.getcurrent()
+
+    def prefetch(self, session, item, container_id):
+        """
+        Download the next items into the item cache, one at a time, until the
+        count or byte budget is reached.
+        """
+
+        if self.is_cancelled(session):
+            return
+
+        try:
+            rows = self.get_next_items(item, container_id)
+            budget = self.budget
+
+            for row in rows:
+                if self.is_cancelled(session):
+                    break
+
+                file_size = row["file_size"] or 0
+
+                if file_size > budget:
+                    break
+
+                budget -= file_size
+
+                connection = self.connections[item.database_id]
+                cache_key = connection.get_item_cache_key(
+                    row["id"], row["file_suffix"])
+
+                if self.cache_manager.item_cache.contains(cache_key):
+                    continue
+
+                logger.debug("Prefetching item '%s'.", cache_key)
+
+                self.cache_manager.cache_file(
+                    self.cache_manager.item_cache, cache_key,
+                    connection.get_item_fd, row["remote_id"],
+                    row["file_suffix"], priority=downloads.PREFETCH,
+                    on_cached=self.cache_manager.on_item_cached(cache_key),
+                    file_size=self.cache_manager.get_resumable_size(
+                        cache_key, row),
+                    cost_class=connection.get_cost_class(row["file_suffix"]))
+        except Exception as e:
+            logger.warning(
+                "Prefetching after item '%d' failed: %s", item.id, e)
+        finally:
+            if not self.is_cancelled(session):
+                del self.greenlets[session]
+
+    def get_next_items(self, item, container_id):
+        """
+        Get the items that follow an item. If the item is part of a container
+        (other than the base container), the container order is used.
+        Otherwise, the album tracks are used.
+        """
+
+        with self.db.get_cursor() as cursor:
+            if container_id is not None:
+                rows = cursor.query(
+                    """
+                    SELECT
+                        `items`.`id`,
+                        `items`.`remote_id`,
+                        `items`.`file_suffix`,
+                        `items`.`file_size`
+                    FROM
+                        `container_items`
+                    INNER JOIN
+                        `containers` ON
+                            `container_items`.`container_id` =
+                                `containers`.`id`
+                    INNER JOIN
+                        `items` ON `container_items`.`item_id` = `items`.`id`
+                    INNER JOIN
+                        `container_items` AS `current` ON
+                            `current`.`container_id` =
+                                `container_items`.`container_id` AND
+                            `current`.`item_id` = ?
+                    WHERE
+                        `containers`.`id` = ? AND
+                        `containers`.`is_base` = 0 AND
+                        `container_items`.`order` > `current`.`order` AND
+                        `items`.`exclude` = 0
+                    ORDER BY
+                        `container_items`.`order`
+                    LIMIT ?
+                    """, item.id, container_id, self.count).fetchall()
+
+                if rows:
+                    return rows
+
+            return cursor.query(
+                """
+                SELECT
+                    `items`.`id`,
+                    `items`.`remote_id`,
+                    `items`.`file_suffix`,
+                    `items`.`file_size`
+                FROM
+                    `items`
+                WHERE
+                    `items`.`album_id` = ? AND
+                    `items`.`track` > ? AND
+                    `items`.`exclude` = 0
+                ORDER BY
+                    `items`.`track`
+                LIMIT ?
+                """, item.album_id, item.track or 0, self.count).fetchall()
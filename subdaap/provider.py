@@ -1,14 +1,30 @@
 from subdaap.models import Server
+from subdaap import cache, downloads, stream, utils
 
 from daapserver.utils import generate_persistent_id
 from daapserver import provider
 
+from flask import request
+
 import logging
 
 # Logger instance
 logger = logging.getLogger(__name__)
 
 
+class Session(provider.Session):
+    """
+    Session that remembers the container that was browsed last.
+    """
+
+    __slots__ = provider.Session.__slots__ + ("container_id", )
+
+    def __init__(self):
+        super(Session, self).__init__()
+
+        self.container_id = None
+
+
 class Provider(provider.Provider):
 
     # SubSonic has support for artwork.
@@ -17,7 +33,11 @@ class Provider(provider.Provider):
     # Persistent IDs are supported.
     supports_persistent_id = True
 
-    def __init__(self, server_name, db, state, connections, cache_manager):
+    # Sessions track the container that was browsed last.
+    session_class = Session
+
+    def __init__(self, server_name, db, state, connections, cache_manager,
+                 prefetcher=None):
         """
         """
 
@@ -28,6 +48,9 @@ class Provider(provider.Provider):
         self.state = state
         self.connections = connections
         self.cache_manager = cache_manager
+        self.prefetcher = prefetcher
+
+        self.hooks["session_destroyed"].append(self.on_session_destroyed)
 
         self.setup_state()
         self.setup_server()
@@ -49,32 +72,99 @@ class Provider(provider.Provider):
         self.server.name = self.server_name
         self.server.persistent_id = self.state["persistent_id"]
 
+    def on_session_destroyed(self, session_id):
+        """
+        Stop prefetching for sessions that are gone.
+        """
+
+        if self.prefetcher:
+            for session in self.prefetcher.greenlets.keys():
+                if session not in self.sessions.itervalues():
+                    self.prefetcher.cancel(session)
+
+    def get_container_items(self, session_id, database_id, container_id,
+                            revision, delta):
+        """
+        Remember the container that is browsed, so the items that are likely
+        to be played next can be prefetched.
+        """
+
+        self.sessions[session_id].container_id = container_id
+
+        return super(Provider, self).get_container_items(
+            session_id, database_id, container_id, revision, delta)
+
     def get_artwork_data(self, session, item):
         """
         Get artwork data from cache or remote.
         """
 
-        cache_item = self.cache_manager.artwork_cache.get(item.id)
+        # Clients ask for artwork of a certain size. Fetch the nearest size
+        # variant, instead of the (possibly huge) original.
+        size = self.cache_manager.artwork_cache.get_size(
+            request.args.get("mw", type=int),
+            request.args.get("mh", type=int))
+
+        # Items of the same album share their artwork.
+        cache_key = cache.artwork_cache_key(
+            item.id, item.album_id, item.album_art, size)
+
+        # Hot artwork is served from memory.
+        data = self.cache_manager.artwork_cache.memory.get(cache_key)
+
+        if data is not None:
+            # The disk copy is marked as accessed, so it is not pruned (and
+            # dropped from memory) as if it were never used.
+            self.cache_manager.artwork_cache.touch(cache_key)
+
+            logger.debug("Artwork data from memory, size=%d", len(data))
+            return data, None, len(data)
+
+        cache_item = self.cache_manager.artwork_cache.get(cache_key)
 
         if cache_item.iterator is None:
-            remote_fd = self.connections[item.database_id].get_artwork_fd(
-                item.remote_id, item.file_suffix)
-            self.cache_manager.artwork_cache.download(
-                item.id, cache_item, remote_fd)
+            connection = self.connections[item.database_id]
+
+            try:
+                remote_fd = connection.get_artwork_fd(
+                    item.album_art_id or item.remote_id, item.file_suffix,
+                    size)
+                self.cache_manager.artwork_cache.download(
+                    cache_key, cache_item, remote_fd,
+                    cost_class=connection.get_cost_class(
+                        item.file_suffix, artwork=True))
+            except BaseException:
+                # Forget the claimed item, so waiting requests try again.
+                self.cache_manager.artwork_cache.discard(cache_key)
+                raise
+
+        if cache_item.downloading:
+            if cache_item.prioritize:
+                cache_item.prioritize(downloads.ARTWORK)
 
             logger.debug("Artwork data from remote, size=unknown")
             return cache_item.iterator(), None, None
 
         logger.debug(
             "Artwork data from cache, size=%d", cache_item.size)
-        return cache_item.iterator(), None, cache_item.size
+        return cache_item.iterator(sock=self.get_client_socket()), None, \
+            cache_item.size
 
     def get_item_data(self, session, item, byte_range=None):
         """
         Get item data from cache or remote.
         """
 
-        cache_item = self.cache_manager.item_cache.get(item.id)
+        is_start = not (byte_range and byte_range[0])
+
+        # A stream start (not a seek) means the next items will likely be
+        # played soon.
+        if self.prefetcher and is_start:
+            self.prefetcher.schedule(session, item, session.container_id)
+
+        if is_start:
+            self.cache_manager.record_play(item.id)
+
         connection = self.connections[item.database_id]
         is_transcode = connection.needs_transcoding(item.file_suffix)
         item_file_type = item.file_type
@@ -82,24 +172,99 @@ class Provider(provider.Provider):
         if is_transcode:
             item_file_type = connection.transcode_format[item.file_type]
 
+        cache_key = connection.get_item_cache_key(item.id, item.file_suffix)
+        item_cache = self.cache_manager.item_cache
+
+        # Hot items are served from memory.
+        data = item_cache.get_memory(cache_key, played=is_start)
+
+        if data is not None:
+            # Mark the disk copy as accessed, so it is not pruned first.
+            item_cache.touch(cache_key)
+
+            logger.debug(
+                "Item data from memory, range=%s, type=%s, size=%d",
+                byte_range, item_file_type, len(data))
+            item_cache.count_served("memory", byte_range, len(data))
+            return stream.stream_from_buffer(data, len(data))(byte_range), \
+                item_file_type, len(data)
+
+        cache_item = item_cache.get(cache_key)
+
         if cache_item.iterator is None:
-            remote_fd = connection.get_item_fd(
-                item.remote_id, item.file_suffix)
-            self.cache_manager.item_cache.download(
-                item.id, cache_item, remote_fd)
+            try:
+                # Start from the head of the item, if it is cached.
+                if not is_transcode and item.file_size and \
+                        not item_cache.has_partial(cache_key):
+                    self.cache_manager.seed_item(cache_key)
+
+                # When seeking into an item that is not transcoded, download
+                # the requested range first and fill the gaps in the
+                # background. This is also used to resume an interrupted
+                # download.
+                is_seek = bool(byte_range and byte_range[0])
+
+                if (is_seek or item_cache.has_partial(cache_key)) and \
+                        not is_transcode and item.file_size:
+                    def remote_fd_factory(byte_range):
+                        return connection.get_item_fd(
+                            item.remote_id, item.file_suffix,
+                            byte_range=byte_range)
+
+                    item_cache.download_ranged(
+                        cache_key, cache_item, remote_fd_factory,
+                        item.file_size,
+                        cost_class=connection.get_cost_class(item.file_suffix))
+                else:
+                    remote_fd = connection.get_item_fd(
+                        item.remote_id, item.file_suffix)
+                    item_cache.download(
+                        cache_key, cache_item, remote_fd,
+                        on_cached=self.cache_manager.on_item_cached(
+                            cache_key, self.cache_manager.get_head_size(
+                                item.file_size, item.duration)),
+                        cost_class=connection.get_cost_class(item.file_suffix))
+            except BaseException:
+                # Forget the claimed item, so waiting requests try again.
+                item_cache.discard(cache_key)
+                raise
+
+        # The item is being downloaded, possibly by another request. Its data
+        # is streamed while it lands on disk.
+        if cache_item.downloading:
             item_size = item.file_size
 
-            # Determine returned size by checking for transcode.
+            # The download may have been started by prefetching or caching,
+            # at a lower priority.
+            if cache_item.prioritize:
+                cache_item.prioritize(downloads.INTERACTIVE)
+
+            # The size of a transcode is only known if it has been transcoded
+            # completely before.
             if is_transcode:
-                item_size = -1
+                item_size = self.cache_manager.get_transcoded_size(
+                    cache_key) or -1
 
             logger.debug(
                 "Item data from remote: range=%s, type=%s, size=%d",
                 byte_range, item_file_type, item_size)
+            item_cache.count_served("remote", byte_range, item_size)
             return cache_item.iterator(byte_range), item_file_type, item_size
 
+        item_cache.promote(cache_key, cache_item)
+
         logger.debug(
             "Item data from cache, range=%s, type=%s, size=%d",
             byte_range, item.file_type, item.file_size)
-        return cache_item.iterator(byte_range), item_file_type, \
+        item_cache.count_served("disk", byte_range, cache_item.size)
+        return cache_item.iterator(
+            byte_range, sock=self.get_client_socket()), item_file_type, \
             cache_item.size
+
+    def get_client_socket(self):
+        """
+        Get the socket of the client of the current request, so cached data
+        can be sent directly to it. Returns None if it is not available.
+        """
+
+        return utils.get_client_socket(request.environ)
@@ -1,142 +1,588 @@
 from daapserver.utils import parse_byte_range
 
+import ctypes.util
+import ctypes
 import shutil
 import gevent
+import gevent.event
 import gevent.queue
+import gevent.socket
+import errno
+import time
+import os
+
+# Zero-copy transfers require the `pysendfile' package on Python 2. Otherwise,
+# the file is copied via userspace.
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = getattr(os, "sendfile", None)
+
+# Readahead hints require `posix_fadvise' of the C library, which is not
+# exposed by Python 2. Otherwise, no hints are given.
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+    try:
+        _posix_fadvise = _libc.posix_fadvise64
+    except AttributeError:
+        _posix_fadvise = _libc.posix_fadvise
+
+    _posix_fadvise.argtypes = [
+        ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+except (OSError, AttributeError, TypeError):
+    _posix_fadvise = None
+
+# Advice values of `posix_fadvise', as defined by Linux.
+FADV_SEQUENTIAL = 2
+FADV_WILLNEED = 3
+FADV_DONTNEED = 4
+
+# Number of bytes ahead of the current offset that the kernel is asked to
+# read into the page cache, while streaming a file.
+READAHEAD_WINDOW = 2097152
+
+# Files of at least this size are dropped from the page cache after they have
+# been sent, so one huge file does not push out everything else.
+DONTNEED_MIN_FILE_SIZE = 67108864
+
+# Size of a segment of a file that is downloaded with ranged requests.
+SEGMENT_SIZE = 1048576
+
+# Time in seconds to wait for a segment to be downloaded, before failing.
+TIMEOUT_WAIT_FOR_SEGMENT = 60
+
+# Number of chunks that can be queued for writing to disk, before the
+# download waits for the disk.
+WRITE_BUFFER_CHUNKS = 32
+
+# A client that takes less time than this (in seconds) to consume a chunk gets
+# larger chunks. A client that takes more time gets smaller chunks.
+CHUNK_FAST = 0.005
+CHUNK_SLOW = 0.05
+
+# Maximum number of bytes of all chunks together of streams that are active
+# at the same time. Chunks do not grow beyond their share.
+CHUNK_MEMORY_BUDGET = 16777216
+
+
+class ChunkSizer(object):
+    """
+    Adapt the chunk size of a stream to the throughput of the client. Chunks
+    double in size while the client consumes them fast, e.g. on a LAN, and
+    halve when it is slow. Large chunks reduce the per-chunk overhead, while
+    small chunks keep the memory usage low. All streams share a memory budget.
+    """
+
+    # Number of streams that are active, to share the memory budget.
+    active = 0
+
+    def __init__(self, min_size, max_size=None):
+        """
+        Construct a new chunk sizer.
+
+        :param int min_size: Initial and minimum chunk size, in bytes.
+        :param int max_size: Maximum chunk size in bytes, or None to use a
+                             fixed chunk size.
+        """
+
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size or min_size)
+        self.size = min_size
+
+    def __enter__(self):
+        ChunkSizer.active += 1
+        return self
+
+    def __exit__(self, *args):
+        ChunkSizer.active -= 1
+
+    def update(self, elapsed):
+        """
+        Adapt the chunk size, given the time the client took to consume the
+        previous chunk.
+
+        :param float elapsed: Time in seconds.
+        """
+
+        if self.max_size == self.min_size:
+            return
+
+        if elapsed < CHUNK_FAST:
+            size = self.size * 2
+        elif elapsed > CHUNK_SLOW:
+            size = self.size / 2
+        else:
+            size = self.size
+
+        limit = min(
+            self.max_size, CHUNK_MEMORY_BUDGET / max(ChunkSizer.active, 1))
+        self.size = max(self.min_size, min(limit, size))
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    Give the kernel a hint about how a file will be accessed. This is a no-op
+    if `posix_fadvise' is not available. Errors are ignored, since it is only
+    a hint.
+
+    :param int fd: File descriptor.
+    :param int offset: Offset of the first byte the advice applies to.
+    :param int length: Number of bytes, or 0 for the remainder of the file.
+    :param int advice: One of the `FADV_*` values.
+    """
+
+    if _posix_fadvise is not None:
+        _posix_fadvise(fd, offset, length, advice)
+
+
+class Readahead(object):
+    """
+    Keep the page cache ahead of a reader that streams a file sequentially,
+    by asking the kernel to read the next window in the background. Pages of
+    huge files that have been sent are dropped again.
+
+    The kernel does not drop pages that are memory mapped, so dropping only
+    has effect if the file is sent with `sendfile' (or read with `read').
+    """
+
+    def __init__(self, fd, file_size, begin, end, drop=True):
+        """
+        Construct a new readahead helper, and request the first window.
+
+        :param int fd: File descriptor of the file that is streamed.
+        :param int file_size: Size of the file.
+        :param int begin: Offset of the first byte that will be read.
+        :param int end: Offset of the last byte that will be read (exclusive).
+        :param bool drop: False if the pages that have been read should not be
+                          dropped, e.g. because they are memory mapped.
+        """
+
+        self.fd = fd
+        self.end = end
+        self.drop = drop and file_size >= DONTNEED_MIN_FILE_SIZE
+
+        self.ahead = self.behind = begin
+        self.advance(begin)
+
+    def advance(self, offset):
+        """
+        Notify that all bytes up to an offset have been read.
+
+        :param int offset: Offset of the next byte that will be read.
+        """
+
+        # Request the next window once half of the current one has been read.
+        if self.ahead < self.end and \
+                offset + READAHEAD_WINDOW / 2 >= self.ahead:
+            ahead = min(self.end, offset + READAHEAD_WINDOW)
+            fadvise(self.fd, self.ahead, ahead - self.ahead, FADV_WILLNEED)
+            self.ahead = ahead
+
+        if self.drop and offset - self.behind >= READAHEAD_WINDOW:
+            fadvise(self.fd, self.behind, offset - self.behind, FADV_DONTNEED)
+            self.behind = offset
+
+
+class AsyncWriter(object):
+    """
+    Write chunks to a file from the thread pool, so a slow disk does not block
+    the event loop. Chunks are queued in a bounded buffer, so the download can
+    continue while the previous chunks are written.
+    """
+
+    def __init__(self, fd, buffer_size=WRITE_BUFFER_CHUNKS, on_write=None):
+        """
+        Construct a new asynchronous writer.
+
+        :param file fd: File descriptor to write to.
+        :param int buffer_size: Maximum number of chunks to queue.
+        :param callable on_write: Method that is invoked with the length of
+                                  each chunk, after it has been written and
+                                  flushed.
+        """
+
+        self.fd = fd
+        self.on_write = on_write
+
+        self.queue = gevent.queue.JoinableQueue(buffer_size)
+        self.error = None
+        self.greenlet = gevent.spawn(self._run)
+
+    def write(self, chunk):
+        """
+        Queue a chunk for writing. Blocks the calling greenlet while the buffer
+        is full.
+        """
+
+        if self.error:
+            raise self.error
+
+        self.queue.put(chunk)
+
+    def flush(self):
+        """
+        Wait until all queued chunks have been written.
+        """
+
+        self.queue.join()
+
+        if self.error:
+            raise self.error
+
+    def close(self):
+        """
+        Write the remaining chunks, and stop the writer.
+        """
+
+        self.queue.put(None)
+        self.greenlet.join()
+
+        if self.error:
+            raise self.error
+
+    def _run(self):
+        threadpool = gevent.get_hub().threadpool
+
+        while True:
+            chunk = self.queue.get()
+
+            try:
+                if chunk is None:
+                    break
+
+                # Discard the remaining chunks after a failure.
+                if self.error:
+                    continue
+
+                try:
+                    threadpool.apply(self._write, (chunk, ))
+                except Exception as e:
+                    self.error = e
+                    continue
+
+                if self.on_write:
+                    self.on_write(len(chunk))
+            finally:
+                self.queue.task_done()
+
+    def _write(self, chunk):
+        # Flush, so the chunk is visible to readers once it is announced.
+        self.fd.write(chunk)
+        self.fd.flush()
+
+
+def move_file(source_file, target_file):
+    """
+    Move a file in the thread pool. A move between disks is a copy.
+    """
+
+    gevent.get_hub().threadpool.apply(shutil.move, (source_file, target_file))
+
+
+class Extents(object):
+    """
+    Bitmap that keeps track of the segments of a file that are present on
+    disk. Segments that are being downloaded are claimed, so two downloads do
+    not write the same segment.
+    """
+
+    __slots__ = (
+        "file_size", "segment_size", "count", "remaining", "bitmap",
+        "claimed", "event"
+    )
+
+    def __init__(self, file_size, segment_size=SEGMENT_SIZE):
+        """
+        Construct a new bitmap for a file of a given size.
+
+        :param int file_size: Size of the file, in bytes.
+        :param int segment_size: Size of one segment, in bytes.
+        """
+
+        self.file_size = file_size
+        self.segment_size = segment_size
+        self.count = (file_size + segment_size - 1) // segment_size
+        self.remaining = self.count
+
+        self.bitmap = bytearray((self.count + 7) // 8)
+        self.claimed = set()
+        self.event = gevent.event.Event()
+
+    def segment(self, offset):
+        """
+        Return the segment that contains a given byte offset.
+        """
+
+        return offset // self.segment_size
+
+    def bounds(self, segment):
+        """
+        Return the (begin, end) byte offsets of a segment.
+        """
+
+        begin = segment * self.segment_size
+
+        return begin, min(begin + self.segment_size, self.file_size)
+
+    def is_present(self, segment):
+        """
+        Return True if a segment is present on disk.
+        """
+
+        return bool(self.bitmap[segment >> 3] & (1 << (segment & 7)))
+
+    def is_complete(self):
+        """
+        Return True if all segments are present on disk.
+        """
+
+        return self.remaining == 0
+
+    def is_missing(self, segment):
+        """
+        Return True if a segment is not present and not claimed.
+        """
+
+        return not self.is_present(segment) and segment not in self.claimed
+
+    def mark(self, segment):
+        """
+        Mark a segment as present.
+        """
+
+        if not self.is_present(segment):
+            self.bitmap[segment >> 3] |= 1 << (segment & 7)
+            self.remaining -= 1
+
+    def find_missing(self, start=0):
+        """
+        Return the first segment from `start` that is missing, or None if
+        all segments are either present or claimed.
+        """
+
+        for segment in xrange(start, self.count):
+            if self.is_missing(segment):
+                return segment
+
+    def notify(self):
+        """
+        Wake up all greenlets that are waiting for a change.
+        """
+
+        event, self.event = self.event, gevent.event.Event()
+        event.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for a change (a segment that is marked or unclaimed).
+
+        :return: False if the timeout expired, True otherwise.
+        :rtype: bool
+        """
+
+        return self.event.wait(timeout=timeout)
 
 
 def stream_from_remote(lock, remote_fd, target_file, chunk_size=32768,
-                       on_cache=None):
+                       on_cache=None, on_error=None, max_chunk_size=None):
     """
     Spawn a greenlet to download and cache a file, while simultaniously stream
-    data to the receiver. An additional greenlet is spawned to handle the file
-    download and caching. Every time another block (of interest, depending on
-    start and stop) is available, it will be written to the queue. The streamer
-    blocks until a block of interest is available.
+    data to one or more receivers. The download greenlet writes the file to
+    disk, and every receiver tails the file as it grows, so a receiver that
+    starts later does not have to wait for the download to finish. The
+    download continues when receivers go away, so the file is always cached.
 
     :param file remote_fd: File descriptor of remote file to stream.
     :param str target_file: Path to target file name. Must be writeable.
-    :param int chunk_size: Chunk size to use when reading remote.
+    :param int chunk_size: Chunk size to use when reading remote, and the
+                           initial chunk size of receivers.
     :param callable on_cache: Callback method to invoke when streaming is done.
+    :param callable on_error: Callback method to invoke with the exception if
+                              the download fails.
+    :param int max_chunk_size: Maximum chunk size of receivers that keep up,
+                               see `ChunkSizer`.
     """
 
     temp_file = "%s.temp" % target_file
-    queue = gevent.queue.Queue()
+    state = {
+        "downloader": None, "size": 0, "done": False, "error": None,
+        "event": gevent.event.Event()
+    }
 
-    def _downloader():
-        exhausted = False
-        bytes_read = 0
+    def _notify():
+        """
+        Wake up all receivers that are waiting for more data.
+        """
 
-        with open(temp_file, "wb") as local_fd:
-            try:
-                while True:
-                    chunk = remote_fd.read(chunk_size)
+        event, state["event"] = state["event"], gevent.event.Event()
+        event.set()
 
-                    if not chunk:
-                        exhausted = True
-                        break
+    def _on_write(length):
+        state["size"] += length
+        _notify()
 
-                    local_fd.write(chunk)
-                    bytes_read += len(chunk)
+    def _downloader():
+        try:
+            with open(temp_file, "wb") as local_fd:
+                writer = AsyncWriter(local_fd, on_write=_on_write)
 
-                    # Yield in the form of (chunk_begin, chunk_end, chunk)
-                    yield bytes_read - len(chunk), bytes_read, chunk
-            finally:
-                # Make sure the remaining bytes are read from remote and
-                # written to disk.
-                if not exhausted:
+                try:
                     while True:
                         chunk = remote_fd.read(chunk_size)
 
                         if not chunk:
                             break
 
-                        local_fd.write(chunk)
-                        bytes_read += len(chunk)
+                        writer.write(chunk)
+                finally:
+                    writer.close()
 
-                # Move the temp file to the target file. On the same disk, this
-                # should be an atomic operation.
-                shutil.move(temp_file, target_file)
+            # Move the temp file to the target file. On the same disk, this
+            # should be an atomic operation.
+            move_file(temp_file, target_file)
+        except Exception as e:
+            state["error"] = e
+            _notify()
 
-                # Mark done, for the on_cache
-                exhausted = True
+            if on_error:
+                on_error(e)
 
-        # Invoke callback, if fully exhausted
-        if exhausted and on_cache:
-            on_cache(bytes_read)
+            return
 
-    def _cacher(begin, end):
-        put = False
+        state["done"] = True
+        _notify()
 
-        # Hack (1)
-        old_owner, lock._owner = lock._owner, gevent.getcurrent()
+        if on_cache:
+            with lock:
+                on_cache(state["size"])
 
-        with lock:
-            try:
-                for chunk_begin, chunk_end, chunk in _downloader():
-                    # Ensure that the chunk we have downloaded is a chunk that
-                    # we are interested in. For instance, we may need the
-                    # middle part of a song, but this will mean that we the
-                    # beginning should be downloaded (and saved to file) first.
-                    if (chunk_begin <= begin < chunk_end) or \
-                            (chunk_begin <= end < chunk_end):
-                        put = not put
-
-                    if put:
-                        queue.put((chunk_begin, chunk_end, chunk))
-            finally:
-                # Make sure the streamer stops
-                queue.put(StopIteration)
+    def _open():
+        """
+        Open the file for reading. It may have been moved in the meantime. The
+        file is unbuffered, so data that is appended later is not missed.
+        """
 
-        # Hack (2)
-        lock._owner = old_owner
+        try:
+            return open(temp_file, "rb", 0)
+        except IOError:
+            return open(target_file, "rb", 0)
 
-    def _streamer(byte_range=None):
+    def _streamer(byte_range=None, sock=None):
         begin, end = parse_byte_range(byte_range)
+        sizer = ChunkSizer(chunk_size, max_chunk_size)
 
-        # Spawn the download greenlet.
-        greenlet = gevent.spawn(_cacher, begin, end)
+        # Spawn the download greenlet, for the first receiver only.
+        if state["downloader"] is None:
+            state["downloader"] = gevent.spawn(_downloader)
 
-        try:
-            put = False
+        # Wait until the file exists.
+        while not state["size"] and not state["done"]:
+            if state["error"]:
+                raise state["error"]
 
-            # At this point, the '_cacher' greenlet is already running and
-            # should have downloaded (part of) the file. The part that we are
-            # interested in will be put in the queue.
-            for chunk_begin, chunk_end, chunk in queue:
-                if (chunk_begin <= begin < chunk_end) or \
-                        (chunk_begin <= end < chunk_end):
-                    put = not put
+            if not state["event"].wait(timeout=TIMEOUT_WAIT_FOR_SEGMENT):
+                raise Exception("Waiting for data timed out.")
 
-                if put:
-                    i = max(0, begin - chunk_begin)
-                    j = min(len(chunk), end - chunk_begin)
+        with _open() as local_fd:
+            while begin < end:
+                # Wait for the data of interest, unless the download is done.
+                while begin >= state["size"] and not state["done"]:
+                    if state["error"]:
+                        raise state["error"]
 
-                    yield chunk[i:j]
-        finally:
-            # Make sure the greenlet gets killed when this iterator is closed.
-            greenlet.kill()
+                    if not state["event"].wait(
+                            timeout=TIMEOUT_WAIT_FOR_SEGMENT):
+                        raise Exception("Waiting for data timed out.")
+
+                if begin >= state["size"]:
+                    break
+
+                local_fd.seek(begin)
+                chunk = local_fd.read(
+                    min(sizer.size, end - begin, state["size"] - begin))
+
+                with sizer:
+                    start = time.time()
+                    yield chunk
+                    sizer.update(time.time() - start)
+
+                begin += len(chunk)
 
     return _streamer
 
 
-def stream_from_file(lock, fd, file_size, on_start=None, on_finish=None):
+def send_file(sock, fd, begin, end, readahead=None):
+    """
+    Send a byte range of a file directly to a socket, without copying it via
+    userspace. The socket may be non-blocking.
+
+    :param socket sock: Client socket to send the data to.
+    :param int fd: File descriptor of the file to send.
+    :param int begin: Offset of first byte to send.
+    :param int end: Offset of last byte to send (exclusive).
+    :param Readahead readahead: Readahead helper to notify of the progress.
+    :return: Number of bytes sent.
+    :rtype: int
+    """
+
+    out_fd = sock.fileno()
+    offset = begin
+
+    while offset < end:
+        try:
+            sent = sendfile(out_fd, fd, offset, end - offset)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+            gevent.socket.wait_write(out_fd)
+            continue
+
+        # End of file reached.
+        if not sent:
+            break
+
+        offset += sent
+
+        if readahead is not None:
+            readahead.advance(offset)
+
+    return offset - begin
+
+
+def stream_from_file(lock, fd, file_size, chunk_size=32768, on_start=None,
+                     on_finish=None):
     """
     Create an iterator that streams a file partially or all at once.
+
+    If a client socket is passed to the iterator and zero-copy transfers are
+    supported, only the first chunk is yielded (so the headers are sent) and
+    the remainder is sent directly to the socket.
     """
 
-    def _streamer(byte_range=None):
+    def _streamer(byte_range=None, sock=None):
         begin, end = parse_byte_range(byte_range, max_byte=file_size)
 
         try:
             if on_start:
                 on_start()
 
-            with lock:
-                fd.seek(begin)
-                chunk = fd.read(end - begin)
+            if sock is not None and sendfile is not None and \
+                    end - begin > chunk_size:
+                with lock:
+                    fd.seek(begin)
+                    chunk = fd.read(chunk_size)
 
-            yield chunk
+                yield chunk
+
+                send_file(sock, fd.fileno(), begin + len(chunk), end)
+            else:
+                with lock:
+                    fd.seek(begin)
+                    chunk = fd.read(end - begin)
+
+                yield chunk
         finally:
             if on_finish:
                 on_finish()
@@ -144,13 +590,36 @@ def stream_from_file(lock, fd, file_size, on_start=None, on_finish=None):
     return _streamer
 
 
-def stream_from_buffer(lock, data, file_size, chunk_size=32768, on_start=None,
-                       on_finish=None):
+def stream_from_buffer(data, file_size, chunk_size=32768, fd=None,
+                       on_start=None, on_finish=None, max_chunk_size=None):
     """
+    Create an iterator that streams a buffer (e.g. a memory mapped file) in
+    chunks. The buffer should not change while it is streamed, so concurrent
+    readers do not need a lock. The owner of the buffer must not close it
+    while it is in use.
+
+    Chunks grow from `chunk_size` up to `max_chunk_size` while the client
+    keeps up, see `ChunkSizer`.
+
+    If the file descriptor of the buffer is given, a client socket is passed to
+    the iterator and zero-copy transfers are supported, only the first chunk is
+    yielded (so the headers are sent) and the remainder is sent directly to
+    the socket. The file descriptor is also used to read ahead.
     """
 
-    def _streamer(byte_range=None):
+    def _streamer(byte_range=None, sock=None):
         begin, end = parse_byte_range(byte_range, max_byte=file_size)
+        zero_copy = sock is not None and fd is not None and \
+            sendfile is not None
+
+        # Pages that are read via the memory map cannot be dropped.
+        if fd is not None:
+            readahead = Readahead(
+                fd, file_size, begin, end, drop=zero_copy)
+        else:
+            readahead = None
+
+        sizer = ChunkSizer(chunk_size, max_chunk_size)
 
         # Yield data in chunks
         try:
@@ -158,15 +627,25 @@ def stream_from_buffer(lock, data, file_size, chunk_size=32768, on_start=None,
                 on_start()
 
             while True:
-                with lock:
-                    chunk = data[begin:min(end, begin + chunk_size)]
+                chunk = data[begin:min(end, begin + sizer.size)]
 
                 # Send the data
-                yield chunk
+                with sizer:
+                    start = time.time()
+                    yield chunk
+                    sizer.update(time.time() - start)
 
                 # Increment offset
                 begin += len(chunk)
 
+                if readahead is not None:
+                    readahead.advance(begin)
+
+                # Send the remainder directly, now the headers have been sent.
+                if zero_copy and begin < end:
+                    send_file(sock, fd, begin, end, readahead=readahead)
+                    break
+
                 # Stop when the end has been reached
                 if begin >= end:
                     break
@@ -175,3 +654,270 @@ def stream_from_buffer(lock, data, file_size, chunk_size=32768, on_start=None,
                 on_finish()
 
     return _streamer
+
+
+def stream_from_remote_ranged(lock, remote_fd_factory, target_file, file_size,
+                              chunk_size=32768, on_cache=None, on_error=None):
+    """
+    Download a file using ranged requests into a sparse file, while streaming
+    data to one or more receivers. Each receiver only waits for the segments
+    it is interested in: a download is started at the requested offset, and
+    the remaining gaps are filled by a background greenlet.
+
+    The segments that are present are recorded next to the temp file. If a
+    temp file is left behind by an interrupted download, the download is
+    resumed: the recorded segments of a sparse temp file, or the prefix of a
+    sequentially written temp file are reused.
+
+    :param callable remote_fd_factory: Method that is invoked with a tuple of
+                                       (begin, end) and should return a file
+                                       descriptor of that byte range.
+    :param str target_file: Path to target file name. Must be writeable.
+    :param int file_size: Size of the remote file, in bytes.
+    :param int chunk_size: Chunk size to use when reading remote.
+    :param callable on_cache: Callback method to invoke when all segments have
+                              been downloaded.
+    :param callable on_error: Callback method to invoke with the exception if
+                              the download fails. The temp file is kept, so
+                              the download can be resumed.
+    """
+
+    temp_file = "%s.temp" % target_file
+    extents_file = "%s.extents" % temp_file
+    extents = Extents(file_size)
+    state = {"filler": None, "error": None}
+    threadpool = gevent.get_hub().threadpool
+
+    def _resume():
+        """
+        Mark the segments of a leftover temp file that can be reused.
+
+        :return: True if the temp file can be reused, False otherwise.
+        :rtype: bool
+        """
+
+        if os.path.exists(extents_file):
+            with open(extents_file, "rb") as extents_fd:
+                bitmap = bytearray(extents_fd.read())
+
+            if len(bitmap) != len(extents.bitmap) or \
+                    os.path.getsize(temp_file) != file_size:
+                return False
+
+            for segment in xrange(extents.count):
+                if bitmap[segment >> 3] & (1 << (segment & 7)):
+                    extents.mark(segment)
+        else:
+            size = os.path.getsize(temp_file)
+
+            if size > file_size:
+                return False
+
+            # Only complete segments of the prefix are reused.
+            for segment in xrange(extents.count):
+                if extents.bounds(segment)[1] > size:
+                    break
+
+                extents.mark(segment)
+
+        return True
+
+    def _save(bitmap, local_fd=None):
+        """
+        Record the segments that are present. The data of the segments is
+        synced first, and the record is replaced atomically, so a crash never
+        marks a missing segment as present. This method blocks, and should be
+        run in the thread pool.
+
+        :param str bitmap: Copy of the bitmap of the extents.
+        :param file local_fd: Temp file to sync before recording, if any.
+        """
+
+        if local_fd is not None:
+            os.fsync(local_fd.fileno())
+
+        with open("%s.temp" % extents_file, "wb") as extents_fd:
+            extents_fd.write(bitmap)
+
+        os.rename("%s.temp" % extents_file, extents_file)
+
+    def _prepare():
+        """
+        Prepare the temp file, resuming a leftover one if possible. This
+        method blocks, and should be run in the thread pool.
+        """
+
+        if os.path.exists(temp_file) and _resume():
+            # Extend the prefix to a sparse file of the full size.
+            with open(temp_file, "r+b") as local_fd:
+                local_fd.truncate(file_size)
+        else:
+            # Pre-allocate a sparse file, so segments can be written at any
+            # offset.
+            with open(temp_file, "wb") as local_fd:
+                local_fd.truncate(file_size)
+
+        _save(str(extents.bitmap))
+
+    threadpool.apply(_prepare)
+
+    def _fetch(segment):
+        """
+        Download the gap that starts at `segment`, until a segment is reached
+        that is present or claimed by another download.
+        """
+
+        last = segment
+
+        while last < extents.count and extents.is_missing(last):
+            last += 1
+
+        if last == segment:
+            return
+
+        begin = extents.bounds(segment)[0]
+        end = extents.bounds(last - 1)[1]
+        remote_fd = remote_fd_factory((begin, end))
+        claimed = None
+
+        try:
+            with open(temp_file, "r+b") as local_fd:
+                local_fd.seek(begin)
+                writer = AsyncWriter(local_fd)
+
+                try:
+                    for current in xrange(segment, last):
+                        if not extents.is_missing(current):
+                            break
+
+                        extents.claimed.add(current)
+                        claimed = current
+                        position, current_end = extents.bounds(current)
+
+                        while position < current_end:
+                            chunk = remote_fd.read(
+                                min(chunk_size, current_end - position))
+
+                            if not chunk:
+                                raise IOError(
+                                    "Remote file ended at byte %d, expected "
+                                    "%d bytes." % (position, file_size))
+
+                            writer.write(chunk)
+                            position += len(chunk)
+
+                        # Make the segment visible to readers before
+                        # marking it.
+                        writer.flush()
+
+                        extents.claimed.discard(current)
+                        extents.mark(current)
+                        extents.notify()
+                        claimed = None
+
+                        threadpool.apply(
+                            _save, (str(extents.bitmap), local_fd))
+                finally:
+                    writer.close()
+        finally:
+            if claimed is not None:
+                extents.claimed.discard(claimed)
+                extents.notify()
+
+            remote_fd.close()
+
+    def _filler():
+        """
+        Download all missing segments, and finish the cache file when done.
+        """
+
+        try:
+            while not extents.is_complete():
+                segment = extents.find_missing()
+
+                # All missing segments are claimed, wait for them.
+                if segment is None:
+                    extents.wait(timeout=TIMEOUT_WAIT_FOR_SEGMENT)
+                    continue
+
+                _fetch(segment)
+
+            # Move the temp file to the target file. On the same disk, this
+            # should be an atomic operation.
+            move_file(temp_file, target_file)
+            os.remove(extents_file)
+        except Exception as e:
+            state["error"] = e
+            extents.notify()
+
+            if on_error:
+                on_error(e)
+
+            return
+
+        if on_cache:
+            with lock:
+                on_cache(file_size)
+
+    def _open():
+        """
+        Open the file for reading. It may have been moved in the meantime. The
+        file is unbuffered, so no stale data of missing segments is read.
+        """
+
+        try:
+            return open(temp_file, "rb", 0)
+        except IOError:
+            return open(target_file, "rb", 0)
+
+    def _streamer(byte_range=None, sock=None):
+        begin, end = parse_byte_range(byte_range, max_byte=file_size)
+        fetcher = None
+
+        # Spawn the background greenlet that fills all gaps.
+        if state["filler"] is None:
+            state["filler"] = gevent.spawn(_filler)
+
+        try:
+            with _open() as local_fd:
+                while begin < end:
+                    segment = extents.segment(begin)
+                    last_change = time.time()
+
+                    # Wait for the segment of interest. If no one is
+                    # downloading it, start a download at this position.
+                    while not extents.is_present(segment):
+                        if state["error"] is not None:
+                            raise state["error"]
+
+                        # Do not retry a download that failed, the filler
+                        # will fail on the same segment.
+                        if fetcher is not None and fetcher.exception:
+                            raise fetcher.exception
+
+                        if extents.is_missing(segment) and \
+                                (fetcher is None or fetcher.dead):
+                            fetcher = gevent.spawn(_fetch, segment)
+
+                        if extents.wait(timeout=TIMEOUT_WAIT_FOR_SEGMENT):
+                            last_change = time.time()
+                        elif time.time() - last_change > \
+                                TIMEOUT_WAIT_FOR_SEGMENT:
+                            raise Exception("Waiting for segment timed out.")
+
+                    stop = min(end, extents.bounds(segment)[1])
+
+                    while begin < stop:
+                        local_fd.seek(begin)
+                        chunk = local_fd.read(min(chunk_size, stop - begin))
+
+                        yield chunk
+
+                        begin += len(chunk)
+        finally:
+            # Only the download started for this receiver is stopped. The
+            # filler continues in the background.
+            if fetcher is not None:
+                fetcher.kill()
+
+    return _streamer
@@ -12,6 +12,7 @@ class SubsonicClient(libsonic.Connection):
     - Parse URL for host and port for constructor.
     - Make sure API results are of of uniform type.
     - Provide methods to intercept URL of binary requests.
+    - Support downloading a byte range of a file.
     - Add order property to playlist items.
     - Add conventient `walk_*' methods to iterate over the API responses.
     """
@@ -260,6 +261,44 @@ class SubsonicClient(libsonic.Connection):
 
         return url
 
+    def download(self, sid, byte_range=None):
+        """
+        Improve the download method. Add support for downloading a byte range
+        of a file, given a tuple of (begin, end), where end is exclusive.
+
+        If the server ignores the range, the leading bytes are skipped, so the
+        result always starts at `begin`.
+
+        The range header is only added to this request, because the client is
+        shared by concurrent requests.
+        """
+
+        if not byte_range:
+            return super(SubsonicClient, self).download(sid)
+
+        begin, end = byte_range
+        request = self._getRequest("download.view", {"id": sid})
+        request.add_header("Range", "bytes=%d-%s" % (
+            begin or 0, "" if end is None else end - 1))
+
+        response = self._doBinReq(request)
+
+        if isinstance(response, dict):
+            self._checkStatus(response)
+
+        if begin and response.getcode() != 206:
+            remaining = begin
+
+            while remaining > 0:
+                chunk = response.read(min(remaining, 65536))
+
+                if not chunk:
+                    break
+
+                remaining -= len(chunk)
+
+        return response
+
     def _doBinReq(self, *args, **kwargs):
         """
         Intercept request URL to provide the URL of the item that is requested.
@@ -114,7 +114,10 @@ class Synchronizer(object):
                 # Items
                 logger.debug("Synchronizing items.")
 
-                if self.items_version != state.get("items_version"):
+                # Albums that were synchronized before the cover art ID was
+                # stored need a full pass to fill it in.
+                if self.items_version != state.get("items_version") or \
+                        not state.get("album_art_names"):
                     self.sync_items()
                     items_changed = True
                 else:
@@ -148,6 +151,9 @@ class Synchronizer(object):
             state["items_version"] = self.items_version
             state["containers_version"] = self.containers_version
 
+            if items_changed:
+                state["album_art_names"] = True
+
             self.state.save()
 
         logger.info("Synchronization finished.")
@@ -453,6 +459,7 @@ class Synchronizer(object):
                 `albums`.`remote_id`,
                 `albums`.`id`,
                 `albums`.`artist_id`,
+                `albums`.`art_name`,
                 `albums`.`checksum`
             FROM
                 `albums`
@@ -644,7 +651,9 @@ class Synchronizer(object):
                 checksum,
                 item_id)
         else:
-            updated = False
+            # Items use the cover art of their album, so they are reloaded
+            # when the album has changed.
+            updated = bool(album and album["updated"])
             item_id = row["id"]
 
         # Update cache
@@ -816,6 +825,12 @@ class Synchronizer(object):
         checksum = utils.dict_checksum(album)
         artist_row = self.artists_by_remote_id.get(album.get("artistId"))
 
+        # The cover art ID is stored as text.
+        art_name = album.get("coverArt")
+
+        if art_name is not None:
+            art_name = unicode(art_name)
+
         # Fetch existing item
         try:
             row = self.albums_by_remote_id[album["id"]]
@@ -833,18 +848,21 @@ class Synchronizer(object):
                    `artist_id`,
                    `name`,
                    `art`,
+                   `art_name`,
                    `checksum`,
                    `remote_id`)
                 VALUES
-                   (?, ?, ?, ?, ?, ?)
+                   (?, ?, ?, ?, ?, ?, ?)
                 """,
                 self.database_id,
                 artist_row["id"] if artist_row else None,
                 album["name"],
                 "coverArt" in album,
+                art_name,
                 checksum,
                 album["id"]).lastrowid
-        elif row["checksum"] != checksum:
+        elif row["checksum"] != checksum or \
+                row["art_name"] != art_name:
             album_id = row["id"]
             self.cursor.query(
                 """
@@ -853,12 +871,14 @@ class Synchronizer(object):
                 SET
                    `name` = ?,
                    `art` = ?,
+                   `art_name` = ?,
                    `checksum` = ?
                 WHERE
                     `albums`.`id` = ?
                 """,
                 album["name"],
                 "coverArt" in album,
+                art_name,
                 checksum,
                 album_id)
         else:
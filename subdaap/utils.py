@@ -94,6 +94,22 @@ def force_list(value):
         return [value]
 
 
+def get_client_socket(environ):
+    """
+    Get the client socket of a WSGI request. This is only supported by the
+    gevent WSGI server.
+
+    :param dict environ: WSGI environment of the request.
+    :return: Client socket, or None if it is not available.
+    :rtype: socket
+    """
+
+    try:
+        return environ["wsgi.input"].rfile._sock
+    except (KeyError, AttributeError):
+        return None
+
+
 def human_bytes(size):
     """
     Convert a given size (in bytes) to a human-readable representation.
@@ -0,0 +1,171 @@
+from collections import OrderedDict
+
+import logging
+import gevent
+import gevent.pool
+import time
+
+# Logger instance
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    """
+    Token bucket that limits the number of bytes per second. The limiter can
+    be shared by multiple greenlets, so they share the bandwidth.
+    """
+
+    def __init__(self, rate):
+        """
+        Construct a new rate limiter.
+
+        :param int rate: Maximum number of bytes per second.
+        """
+
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.time()
+
+    def consume(self, amount):
+        """
+        Consume a number of bytes. Blocks the calling greenlet if the rate is
+        exceeded, until the bytes are allowed.
+
+        :param int amount: Number of bytes.
+        """
+
+        now = time.time()
+
+        self.allowance = min(
+            self.rate, self.allowance + (now - self.last) * self.rate)
+        self.allowance -= amount
+        self.last = now
+
+        if self.allowance < 0:
+            gevent.sleep(-self.allowance / float(self.rate))
+
+
+class RateLimitedFile(object):
+    """
+    Wrapper for a file-like object, that limits the rate of reading.
+    """
+
+    def __init__(self, fd, limiter):
+        self.fd = fd
+        self.limiter = limiter
+
+    def read(self, size=-1):
+        data = self.fd.read(size)
+        self.limiter.consume(len(data))
+
+        return data
+
+    def close(self):
+        self.fd.close()
+
+
+class CacheWarmer(object):
+    """
+    Background queue of jobs that download items and artwork into the caches.
+    Jobs run concurrently, and share a bandwidth cap.
+    """
+
+    def __init__(self, concurrency=1, bandwidth=0, on_idle=None):
+        """
+        Construct a new cache warmer.
+
+        :param int concurrency: Number of jobs to run at the same time.
+        :param int bandwidth: Maximum download rate (in KB/s) of all jobs
+                              together, or 0 for unlimited.
+        :param callable on_idle: Method to invoke when all jobs are done.
+        """
+
+        self.pool = gevent.pool.Pool(concurrency)
+        self.limiter = RateLimiter(bandwidth * 1024) if bandwidth else None
+        self.on_idle = on_idle
+
+        self.pending = OrderedDict()
+        self.active = set()
+        self.dispatcher = None
+
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+
+    def is_idle(self):
+        """
+        Return True if there are no pending or active jobs.
+        """
+
+        return not self.pending and not self.active
+
+    def enqueue(self, key, job):
+        """
+        Add a job to the queue, unless a job with the same key is already
+        queued or running.
+
+        :param str key: Unique key of the job.
+        :param callable job: Method to invoke. It receives a method that wraps
+                             a remote file descriptor, to apply the bandwidth
+                             cap.
+        """
+
+        if key in self.pending or key in self.active:
+            return
+
+        # Start counting progress for a new batch.
+        if self.is_idle():
+            self.total = self.done = self.failed = 0
+
+        self.pending[key] = job
+        self.total += 1
+
+        if self.dispatcher is None or self.dispatcher.dead:
+            self.dispatcher = gevent.spawn(self.dispatch)
+
+    def dispatch(self):
+        """
+        Start pending jobs as soon as the pool has room for them.
+        """
+
+        while self.pending:
+            self.pool.wait_available()
+
+            key, job = self.pending.popitem(last=False)
+            self.active.add(key)
+
+            self.pool.spawn(self.run, key, job)
+
+    def run(self, key, job):
+        """
+        Run a single job, and update the progress.
+        """
+
+        try:
+            job(self.limit)
+            self.done += 1
+        except Exception as e:
+            logger.warning("Cache warming job '%s' failed: %s", key, e)
+            self.failed += 1
+        finally:
+            self.active.discard(key)
+
+        if self.is_idle():
+            logger.info(
+                "Cache warming finished: %d jobs done, %d failed.",
+                self.done, self.failed)
+
+            if self.on_idle:
+                self.on_idle()
+
+    def limit(self, remote_fd):
+        """
+        Apply the bandwidth cap to a remote file descriptor.
+
+        :param file remote_fd: File descriptor to wrap.
+        """
+
+        if self.limiter is None:
+            return remote_fd
+
+        return RateLimitedFile(remote_fd, self.limiter)